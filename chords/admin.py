@@ -1,15 +1,50 @@
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.template.response import TemplateResponse
 
-from .models import Artist, Song
+from .models import Artist, Song, MinHashBand, NameWord, MyCache
 
 
 admin.AdminSite.site_title = 'Chords administration'
 admin.AdminSite.site_header = 'Chords Administration'
 
+class EstimatedCountPaginator(Paginator):
+    """
+    On PostgreSQL, take the number of rows of an unfiltered changelist from
+    the table statistics instead of running a COUNT(*) over the whole table.
+    Filtered querysets are counted as usual.
+    """
+    def _get_count(self):
+        if self._count is None and not self.object_list.query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT reltuples FROM pg_class WHERE relname = %s',
+                        [self.object_list.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] > 0:
+                    self._count = int(row[0])
+        return super(EstimatedCountPaginator, self)._get_count()
+    count = property(_get_count)
+
 class ArtistAdmin(admin.ModelAdmin):
     exclude = ['slug']
     actions = ['delete_selected']
+    # matched against the name index, see get_search_results()
     search_fields = ['name']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # every word of the search term must start a word of the name
+        for word in NameWord.words(search_term):
+            queryset = queryset.filter(
+                    id__in=NameWord.ids_starting_with('artist', word))
+        return queryset, False
 
     def delete_selected(self, request, queryset):
         for artist in queryset:
@@ -26,21 +61,77 @@ class SongAdmin(admin.ModelAdmin):
     ]
 
     list_display = ['full_title', 'reg_date', 'pub_date', 'published']
+    list_select_related = ['artist']
     list_filter = ['pub_date', 'reg_date', 'genre', 'tabs']
+    # matched against the name index, see get_search_results()
     search_fields = ['title', 'artist__name']
     actions = ['delete_selected', 'publish_songs', 'unpublish_songs']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        # every word of the search term must start a word of the title or
+        # of the artist name
+        for word in NameWord.words(search_term):
+            queryset = queryset.filter(
+                    Q(id__in=NameWord.ids_starting_with('song', word)) |
+                    Q(artist__in=NameWord.ids_starting_with('artist', word)))
+        return queryset, False
+
+    def get_urls(self):
+        urls = [
+            url(r'^duplicates/$', self.admin_site.admin_view(self.duplicates_view),
+                name='chords_song_duplicates'),
+        ]
+        return urls + super(SongAdmin, self).get_urls()
+
+    def duplicates_view(self, request):
+        """
+        Report the pairs of songs that are probably duplicates of each other,
+        found through the LSH buckets of their content.
+        """
+        context = dict(self.admin_site.each_context(request),
+                       opts=self.model._meta, title='Probable duplicate songs',
+                       pairs=MinHashBand.duplicate_pairs())
+        return TemplateResponse(request, 'admin/chords/song/duplicates.html',
+                                context)
+
+    # the admin saves and deletes inside a transaction, and Song.save()
+    # invalidates the caches before it commits, so do it again afterwards
+    def save_model(self, request, obj, form, change):
+        artist_ids = {obj.artist_id, getattr(obj, '_stored_artist_id', None)}
+        super(SongAdmin, self).save_model(request, obj, form, change)
+        self.changed_songs(request).append((obj.id, obj.slug, artist_ids))
+
+    def delete_model(self, request, obj):
+        self.changed_songs(request).append((obj.id, obj.slug, {obj.artist_id}))
+        super(SongAdmin, self).delete_model(request, obj)
+
+    def changed_songs(self, request):
+        return request.__dict__.setdefault('changed_songs', [])
+
+    def purge_changed_songs(self, request):
+        for song_id, slug, artist_ids in self.changed_songs(request):
+            MyCache.purge_song(song_id, slug, artist_ids)
+
+    def changeform_view(self, request, *args, **kwargs):
+        response = super(SongAdmin, self).changeform_view(request, *args,
+                                                          **kwargs)
+        self.purge_changed_songs(request)
+        return response
+
+    def delete_view(self, request, *args, **kwargs):
+        response = super(SongAdmin, self).delete_view(request, *args, **kwargs)
+        self.purge_changed_songs(request)
+        return response
 
     def publish_songs(self, request, queryset):
-        for song in queryset:
-            if not song.published:
-                song.publish()
+        queryset.publish()
 
     publish_songs.short_description = 'Publish all selected songs'
 
     def unpublish_songs(self, request, queryset):
-        for song in queryset:
-            if song.published:
-                song.unpublish()
+        queryset.unpublish()
 
     unpublish_songs.short_description = 'Unpublish all selected songs'
 
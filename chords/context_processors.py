@@ -0,0 +1,19 @@
+from django.utils.functional import SimpleLazyObject
+
+from .models import MyCache
+from .utils import SortedIdSet
+
+
+def bookmarks(request):
+    """
+    Expose the ids of the songs bookmarked by the current user as
+    `bookmarked_ids`, so that any list can show the bookmark state of its
+    songs with {% if song.id in bookmarked_ids %}. The cache is only read
+    when a template actually uses it.
+    """
+    def get_bookmarked_ids():
+        if request.user.is_authenticated():
+            return MyCache.bookmarked_song_ids(request.user)
+        return SortedIdSet()
+
+    return {'bookmarked_ids' : SimpleLazyObject(get_bookmarked_ids)}
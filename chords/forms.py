@@ -61,16 +61,25 @@ class AddCommentForm(forms.ModelForm):
             'content' : 'Leave a comment',
         }
 
+    def __init__(self, *args, require_captcha=True, **kwargs):
+        super(AddCommentForm, self).__init__(*args, **kwargs)
+        if not require_captcha:
+            del self.fields['captcha']
+
 
 class SearchForm(forms.Form):
     SEARCH_ARTIST = 'AR'
     SEARCH_SONG = 'SO'
     SEARCH_USER = 'US'
+    SEARCH_LYRICS = 'LY'
+    SEARCH_CHORDS = 'CH'
 
     SEARCHBY_CHOICES = (
         (SEARCH_ARTIST, 'Artist'),
         (SEARCH_SONG, 'Song'),
         (SEARCH_USER, 'User'),
+        (SEARCH_LYRICS, 'Lyrics'),
+        (SEARCH_CHORDS, 'Playable with chords'),
     )
 
     GENRE_ALL = 'ALL'
@@ -88,13 +97,33 @@ class SearchForm(forms.Form):
     keywords = forms.CharField(label='Keywords', max_length=100, required=False)
     genre = forms.ChoiceField(label='Genre', choices=GENRE_CHOICES, required=False)
     tabs = forms.ChoiceField(label='Tabs', choices=TABS_CHOICES, required=False)
+    fuzzy = forms.BooleanField(label='Fuzzy', required=False,
+            help_text='Tolerate typos and greeklish spelling variations.')
+    easy = forms.BooleanField(label='Easy', required=False,
+            help_text='Only songs playable without barre chords.')
 
     def __init__(self, *args, **kwargs):
         super(SearchForm, self).__init__(*args, **kwargs)
         self.fields['keywords'].widget.attrs['placeholder'] = 'Search for...'
 
         for field_name, field in self.fields.items():
-            field.widget.attrs['class'] = 'form-control'
+            if not isinstance(field, forms.BooleanField):
+                field.widget.attrs['class'] = 'form-control'
+
+    def show_facets(self, facets):
+        """
+        Append to the genre and tabs choices the number of results each of
+        them would give. facets is what SongQuerySet.facets() returns.
+        """
+        total = sum(facets['tabs'].values())
+        self.fields['genre'].choices = [
+                (self.GENRE_ALL, 'All ({0})'.format(total))] + [
+                (genre, '{0} ({1})'.format(name, facets['genres'][genre]))
+                for genre, name in Song.GENRE_CHOICES]
+        chords_only = facets['tabs'][False]
+        self.fields['tabs'].choices = [
+                (self.INCLUDE_TABS, 'Include Tabs ({0})'.format(total)),
+                (self.CHORDS_ONLY, 'Chords only ({0})'.format(chords_only))]
 
 
 class ContactForm(forms.Form):
@@ -0,0 +1,209 @@
+import math
+import threading
+from bisect import bisect_left
+from collections import defaultdict, Counter
+
+from .models import Artist, Song, User, MyCache
+from .utils import (slugify_greek, trigrams, normalize_chord, chords_mask,
+                    CHORD_REGEX, SortedIdSet)
+
+
+class VersionedIndex:
+    """
+    Base class for the in-process indexes. An index is built from the
+    database on first use and rebuilt whenever the version of one of the
+    namespaces it is built from changes in the cache, so that every worker
+    notices changes made by the others.
+    """
+    namespaces = (MyCache.Namespaces.CATALOGUE,)
+
+    def __init__(self):
+        self.version = None
+        self.data = None
+        self.lock = threading.Lock()
+
+    def build(self):
+        raise NotImplementedError
+
+    def refresh(self):
+        """
+        Rebuild the index if it is out of date and return its data.
+        """
+        version = tuple(MyCache.generation(namespace)
+                        for namespace in self.namespaces)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    # swap the data in one assignment, so that concurrent
+                    # readers never see a half built index
+                    self.data = self.build()
+                    self.version = version
+        return self.data
+
+
+class PrefixIndex(VersionedIndex):
+    """
+    Index of the slugified titles of published songs, artist names and
+    usernames, kept as a sorted list of keys so that a prefix lookup is a
+    binary search. Every word of a name is indexed, so that "mou" also
+    matches "Αγάπη μου".
+    """
+    SONG = 'song'
+    ARTIST = 'artist'
+    USER = 'user'
+
+    namespaces = (MyCache.Namespaces.CATALOGUE, MyCache.Namespaces.USERNAMES)
+
+    def build(self):
+        pairs = []
+
+        def add(name, entry):
+            key = slugify_greek(name)
+            for i in range(len(key)):
+                if i == 0 or key[i - 1] == '-':
+                    pairs.append((key[i:], entry))
+
+        songs = Song.objects.filter(published=True).values_list('title', 'slug')
+        for title, slug in songs:
+            add(title, (self.SONG, title, slug))
+        for name, slug in Artist.objects.values_list('name', 'slug'):
+            add(name, (self.ARTIST, name, slug))
+        for username in User.objects.values_list('username', flat=True):
+            add(username, (self.USER, username, username))
+
+        pairs.sort(key=lambda pair: pair[0])
+        return [key for key, entry in pairs], [entry for key, entry in pairs]
+
+    def lookup(self, query, limit=10):
+        """
+        Return up to limit (type, name, slug) tuples whose name has a word
+        starting with the given query.
+        """
+        prefix = slugify_greek(query)
+        if not prefix:
+            return []
+
+        keys, entries = self.refresh()
+        results = []
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            if entries[i] not in results:
+                results.append(entries[i])
+                if len(results) == limit:
+                    break
+            i += 1
+        return results
+
+
+class TrigramIndex(VersionedIndex):
+    """
+    Typo tolerant index of names, based on the trigrams of their greeklish
+    normalized form. Maps every trigram to the ids of the objects having it
+    and ranks matches by the jaccard similarity of the trigram sets.
+    """
+    def __init__(self, get_names):
+        """
+        get_names -- callable returning the (id, name) pairs to index
+        """
+        super(TrigramIndex, self).__init__()
+        self.get_names = get_names
+
+    def build(self):
+        postings = defaultdict(list)
+        sizes = {}
+        for obj_id, name in self.get_names():
+            grams = trigrams(name)
+            sizes[obj_id] = len(grams)
+            for gram in grams:
+                postings[gram].append(obj_id)
+        postings = {gram : SortedIdSet(ids) for gram, ids in postings.items()}
+        return postings, sizes
+
+    def search(self, query, threshold=0.3, limit=100):
+        """
+        Return the ids of up to limit objects whose similarity to the query
+        is at least threshold, the most similar first.
+        """
+        grams = trigrams(query)
+        if not grams:
+            return []
+        postings, sizes = self.refresh()
+
+        # An object reaching the threshold shares at least min_shared
+        # trigrams with the query, so it must have one of the
+        # len(grams) - min_shared + 1 rarest ones. Only those postings are
+        # scanned; the rest are probed with binary searches.
+        min_shared = math.ceil(threshold * len(grams))
+        empty = SortedIdSet()
+        grams = sorted(grams, key=lambda gram: len(postings.get(gram, empty)))
+        num_scanned = len(grams) - min_shared + 1
+
+        shared = Counter()
+        for gram in grams[:num_scanned]:
+            shared.update(postings.get(gram, empty))
+        for gram in grams[num_scanned:]:
+            posting = postings.get(gram, empty)
+            for obj_id in shared:
+                if obj_id in posting:
+                    shared[obj_id] += 1
+
+        scored = []
+        for obj_id, count in shared.items():
+            score = count / (len(grams) + sizes[obj_id] - count)
+            if score >= threshold:
+                scored.append((score, obj_id))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [obj_id for score, obj_id in scored[:limit]]
+
+
+class ChordIndex(VersionedIndex):
+    """
+    Index of the chord bitsets of the published songs, in title order. A
+    song is playable with a set of chords when its bitset has no bits
+    outside the bitset of the set, which is a couple of int operations per
+    song.
+    """
+    def build(self):
+        songs = Song.objects.filter(published=True).exclude(
+                chord_mask__in=['', '0']).order_by('title')
+        ids = []
+        masks = []
+        for song_id, mask in songs.values_list('id', 'chord_mask'):
+            ids.append(song_id)
+            masks.append(int(mask, 16))
+        return ids, masks
+
+    def parse(self, query):
+        """
+        Return the chords of a query like "G C d em", normalized.
+        """
+        chords = []
+        for token in query.replace(',', ' ').split():
+            token = token[0].upper() + token[1:]
+            match = CHORD_REGEX.match(token)
+            if match:
+                chords.append(normalize_chord(match.group(0)))
+        return chords
+
+    def search(self, query):
+        """
+        Return the ids of the published songs whose chords are all contained
+        in the chords of the query, in title order.
+        """
+        mask = chords_mask(self.parse(query))
+        if not mask:
+            return []
+        ids, masks = self.refresh()
+        return [song_id for song_id, song_mask in zip(ids, masks)
+                if not song_mask & ~mask]
+
+
+autocomplete_index = PrefixIndex()
+
+chord_index = ChordIndex()
+
+fuzzy_song_index = TrigramIndex(lambda:
+    Song.objects.filter(published=True).values_list('id', 'title'))
+
+fuzzy_artist_index = TrigramIndex(lambda:
+    Artist.objects.values_list('id', 'name'))
@@ -0,0 +1,117 @@
+import math
+import heapq
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chords.models import Song, SongView, RelatedSong
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+
+# a bookmark says more about a user's taste than a view
+VIEW_WEIGHT = 1
+BOOKMARK_WEIGHT = 2
+
+def song_vectors():
+    """
+    Return a dict mapping the id of every published song to a sparse vector
+    of its users, as a dict mapping user ids to weights.
+    """
+    published = set(Song.objects.filter(published=True).values_list('id', flat=True))
+    vectors = defaultdict(lambda: defaultdict(int))
+    views = SongView.objects.values_list('song_id', 'user_id').distinct()
+    bookmarks = Song.bookmarkedBy.through.objects.values_list('song_id', 'user_id')
+    for rows, weight in [(views, VIEW_WEIGHT), (bookmarks, BOOKMARK_WEIGHT)]:
+        for song_id, user_id in rows.iterator():
+            if song_id in published:
+                vectors[song_id][user_id] += weight
+    return vectors
+
+def top_similar_python(vectors, top):
+    """
+    Return a dict mapping song ids to lists of (score, song id) of their top
+    most similar songs by cosine similarity, accumulating the dot products of
+    the songs that share a user.
+    """
+    norms = {song_id : math.sqrt(sum(w * w for w in vector.values()))
+             for song_id, vector in vectors.items()}
+    users = defaultdict(list)
+    for song_id, vector in vectors.items():
+        for user_id, weight in vector.items():
+            users[user_id].append((song_id, weight))
+
+    dots = defaultdict(lambda: defaultdict(float))
+    for songs in users.values():
+        for song_a, weight_a in songs:
+            for song_b, weight_b in songs:
+                if song_a != song_b:
+                    dots[song_a][song_b] += weight_a * weight_b
+
+    similar = {}
+    for song_a, row in dots.items():
+        scores = ((dot / (norms[song_a] * norms[song_b]), song_b)
+                  for song_b, dot in row.items())
+        similar[song_a] = heapq.nlargest(top, scores)
+    return similar
+
+def top_similar_scipy(vectors, top):
+    """
+    Same as top_similar_python(), using a sparse matrix product.
+    """
+    song_ids = list(vectors)
+    user_index = {}
+    rows, cols, data = [], [], []
+    for row, song_id in enumerate(song_ids):
+        for user_id, weight in vectors[song_id].items():
+            rows.append(row)
+            cols.append(user_index.setdefault(user_id, len(user_index)))
+            data.append(weight)
+
+    matrix = scipy.sparse.csr_matrix((data, (rows, cols)),
+            shape=(len(song_ids), len(user_index)), dtype=numpy.float64)
+    norms = numpy.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+    matrix = scipy.sparse.diags(1 / norms).dot(matrix)
+    cosines = matrix.dot(matrix.T).tocsr()
+    cosines.setdiag(0)
+    cosines.eliminate_zeros()
+
+    similar = {}
+    for row, song_id in enumerate(song_ids):
+        start, end = cosines.indptr[row], cosines.indptr[row + 1]
+        if start == end:
+            continue
+        scores = zip(cosines.data[start:end], cosines.indices[start:end])
+        similar[song_id] = [(float(score), song_ids[col])
+                            for score, col in heapq.nlargest(top, scores)]
+    return similar
+
+
+class Command(BaseCommand):
+    help = ('Find the most similar songs of each song, by the users that '
+            'viewed or bookmarked them, and store them for the song pages.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10,
+                            help='Number of related songs to keep per song.')
+
+    def handle(self, *args, **options):
+        vectors = song_vectors()
+        if scipy is not None and vectors:
+            similar = top_similar_scipy(vectors, options['top'])
+        else:
+            similar = top_similar_python(vectors, options['top'])
+
+        with transaction.atomic():
+            RelatedSong.objects.all().delete()
+            RelatedSong.objects.bulk_create(
+                RelatedSong(song_id=song_id, related_id=related_id, score=score)
+                for song_id, scores in similar.items()
+                for score, related_id in scores)
+
+        self.stdout.write('Found related songs for {0} songs.'.format(len(similar)))
@@ -0,0 +1,42 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from chords.models import Song, SongView
+
+
+class Command(BaseCommand):
+    help = ('Move the rows of the old Song.viewedBy relation to the song view '
+            'log and add them to the view counts of the songs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        through = Song.viewedBy.through
+        # the relation has no timestamps, so log the old views as of today
+        today = timezone.now().date()
+        moved = 0
+        while True:
+            with transaction.atomic():
+                rows = list(through.objects.order_by('id').values_list(
+                        'id', 'song_id', 'user_id')[:options['batch_size']])
+                if not rows:
+                    break
+                existing = set(SongView.objects.filter(
+                        day=today, song__in={row[1] for row in rows}
+                        ).values_list('song_id', 'user_id'))
+                SongView.objects.bulk_create(
+                    SongView(song_id=song_id, user_id=user_id, day=today)
+                    for _, song_id, user_id in rows
+                    if (song_id, user_id) not in existing)
+                counts = Counter(song_id for _, song_id, _ in rows)
+                for song_id, count in counts.items():
+                    Song.objects.filter(id=song_id).update(
+                            view_count=F('view_count') + count)
+                through.objects.filter(id__in=[row[0] for row in rows]).delete()
+            moved += len(rows)
+        self.stdout.write('Moved {0} song views.'.format(moved))
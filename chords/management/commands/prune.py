@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chords.models import SongView, SongViewBucket, SongDraft
+
+
+class Command(BaseCommand):
+    help = ('Delete the rows of the song view log, the view buckets and the '
+            'song drafts that are past their retention period.')
+
+    MODELS = {
+        'song_views' : SongView,
+        'view_buckets' : SongViewBucket,
+        'song_drafts' : SongDraft,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*',
+                            help='What to prune, out of {0}. All of them by '
+                                 'default.'.format(', '.join(sorted(self.MODELS))))
+        parser.add_argument('--days', type=int, default=SongView.RETENTION_DAYS,
+                            help='Number of days of song views to keep.')
+
+    def handle(self, *args, **options):
+        names = options['models'] or sorted(self.MODELS)
+        for name in names:
+            if name not in self.MODELS:
+                raise CommandError('Cannot prune {0}, choose from {1}.'.format(
+                        name, ', '.join(sorted(self.MODELS))))
+        for name in names:
+            model = self.MODELS[name]
+            if model is SongView:
+                count = model.prune(options['days'])
+            else:
+                count = model.prune()
+            self.stdout.write('Deleted {0} {1}.'.format(
+                    count, model._meta.verbose_name_plural))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from chords.models import Artist, Song, NameWord, MyCache
+from chords.utils import minhash_signature
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the lyrics index, the near-duplicate index and the chord '
+            'analysis of all songs, and the name index of songs and artists.')
+
+    def handle(self, *args, **options):
+        songs = Song.objects.only('id', 'title', 'content', 'slug', 'artist')
+        slugs = []
+        page_tags = []
+        for song in songs.iterator():
+            NameWord.index(song, song.title)
+            song.index_lyrics()
+            song.minhash = minhash_signature(song.content)
+            song.index_minhash()
+            song.analyze_chords()
+            Song.objects.filter(id=song.id).update(
+                chord_mask=song.chord_mask, key=song.key,
+                best_shift=song.best_shift, barre_chords=song.barre_chords,
+                minhash=song.minhash)
+            slugs.append(song.slug)
+            page_tags.extend(song.page_tags())
+        for artist in Artist.objects.only('id', 'name').iterator():
+            NameWord.index(artist, artist.name)
+
+        # the updates above skip Song.save(), so the chord index, the cached
+        # search results, songs and pages are invalidated here instead
+        MyCache.bump_catalogue_version()
+        MyCache.bump_song_versions(slugs)
+        MyCache.purge_pages(page_tags)
+        self.stdout.write('Reindexed {0} songs.'.format(songs.count()))
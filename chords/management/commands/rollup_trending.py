@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chords.models import SongViewBucket, MyCache
+
+
+class Command(BaseCommand):
+    help = ('Recompute the trending songs from the hourly view buckets and '
+            'prune the expired buckets. Meant to run every hour.')
+
+    def handle(self, *args, **options):
+        ranking = MyCache.update_trending_songs()
+        pruned = SongViewBucket.prune()
+        self.stdout.write('Ranked {0} trending songs, pruned {1} buckets.'
+                          .format(len(ranking), pruned))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chords.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = ('Fill the shared cache with the lists, counts and hottest songs '
+            'the site needs, and check that all templates compile.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--songs', type=int, default=20,
+                            help='Number of hottest songs to cache.')
+
+    def handle(self, *args, **options):
+        songs, templates = warm_up(options['songs'])
+        self.stdout.write('Warmed {0} songs and {1} templates.'.format(
+            songs, templates))
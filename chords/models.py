@@ -1,11 +1,26 @@
-from django.db import models
+import json
+import uuid
+import random
+import datetime
+import hashlib
+import math
+import itertools
+from collections import Counter, deque
+
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
-from django.db.models import Count
+from django.db.models import Count, Sum, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 
-from .utils import generate_unique_slug, strip_whitespace_lines
+from .utils import (generate_unique_slug, strip_whitespace_lines, lyrics_words,
+                    greeklish_normalize, extract_chords, chords_mask, detect_key, best_shift,
+                    minhash_signature, minhash_bands, minhash_similarity,
+                    SortedIdSet, LRUCache)
+from .signals import songs_published, songs_unpublished
 
 
 class Artist(models.Model):
@@ -14,17 +29,44 @@ class Artist(models.Model):
     reg_date = models.DateTimeField('date registered', auto_now_add=True)
     slug = models.SlugField(unique=True)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        artist = super(Artist, cls).from_db(db, field_names, values)
+        # the search indexes only need rebuilding when the name changes
+        artist._stored_name = artist.__dict__.get('name', None)
+        return artist
+
     def save(self, slug_max_length=-1, *args, **kwargs):
-        if self.id is None:
+        created = self.id is None
+        if created:
             self.slug = generate_unique_slug(Artist, self.name, slug_max_length)
             MyCache.incr_value(MyCache.Keys.ARTISTS_COUNT)
 
         super(Artist, self).save(*args, **kwargs)
+        MyCache.delete_sitemap_section('artists', self.id)
+        if self.name != getattr(self, '_stored_name', None):
+            NameWord.index(self, self.name)
+            MyCache.bump_catalogue_version()
+            self._stored_name = self.name
+        MyCache.delete_homepage()
+        MyCache.purge_pages(self.page_tags())
+        if not created:
+            # the cached songs carry their artist
+            MyCache.bump_song_versions(self.songs.values_list('slug', flat=True))
 
     def delete(self, *args, **kwargs):
         MyCache.decr_value(MyCache.Keys.ARTISTS_COUNT)
+        MyCache.delete_sitemap_section('artists', self.id)
+        MyCache.bump_catalogue_version()
+        MyCache.delete_homepage()
+        MyCache.purge_pages(self.page_tags())
+        MyCache.bump_song_versions(self.songs.values_list('slug', flat=True))
         super(Artist, self).delete(*args, **kwargs)
 
+    def page_tags(self):
+        # the song pages of the artist are tagged with the artist too
+        return [MyCache.Tags.ARTIST.format(self.id)] + MyCache.Tags.SONG_LISTS
+
     def get_absolute_url(self):
         return reverse('chords:artist', kwargs={'artist_slug' : self.slug})
 
@@ -32,6 +74,67 @@ class Artist(models.Model):
         return self.name
 
 
+class ExpiringQuerySet(models.QuerySet):
+    """
+    QuerySet of the models whose old rows get pruned, see the prune command.
+    """
+    def prune(self):
+        """
+        Delete the rows of the queryset and return their number, which
+        delete() does not return in this version of Django.
+        """
+        count = self.count()
+        self.delete()
+        return count
+
+
+class SongQuerySet(models.QuerySet):
+    def publish(self):
+        """
+        Publish all unpublished songs of the queryset with a single UPDATE.
+        Return the ids of the songs that got published.
+        """
+        songs = self.filter(published=False)
+        song_ids = list(songs.values_list('id', flat=True))
+        if song_ids:
+            now = timezone.now()
+            songs.update(published=True, pub_date=now, mod_date=now)
+            MyCache.incr_value(MyCache.Keys.PUBLISHED_SONGS_COUNT, len(song_ids))
+            MyCache.delete_recent_songs()
+            MyCache.delete_sitemap_sections('songs', song_ids)
+            songs_published.send(sender=Song, song_ids=song_ids)
+        return song_ids
+
+    def unpublish(self):
+        """
+        Unpublish all published songs of the queryset with a single UPDATE.
+        Return the ids of the songs that got unpublished.
+        """
+        songs = self.filter(published=True)
+        song_ids = list(songs.values_list('id', flat=True))
+        if song_ids:
+            songs.update(published=False, pub_date=None, mod_date=timezone.now())
+            MyCache.decr_value(MyCache.Keys.PUBLISHED_SONGS_COUNT, len(song_ids))
+            MyCache.delete_recent_songs()
+            MyCache.delete_sitemap_sections('songs', song_ids)
+            songs_unpublished.send(sender=Song, song_ids=song_ids)
+        return song_ids
+
+    def facets(self):
+        """
+        Count the songs of the queryset per genre and per tabs, with a single
+        grouped query. Return a dict with the 'genres' counts, keyed by genre,
+        and the 'tabs' counts, keyed by True and False.
+        """
+        genres = {genre : 0 for genre, name in Song.GENRE_CHOICES}
+        tabs = {True : 0, False : 0}
+        rows = self.order_by().values('genre', 'tabs').annotate(count=Count('id'))
+        for row in rows:
+            genres[row['genre']] += row['count']
+            tabs[row['tabs']] += row['count']
+        return {'genres' : genres, 'tabs' : tabs}
+
+
 class Song(models.Model):
     BLUES = 'BLU'
     CLASSIC = 'CLA'
@@ -70,16 +173,52 @@ class Song(models.Model):
                                blank=True, related_name='songs')
     bookmarkedBy = models.ManyToManyField(User, related_name='bookmarks',
                                           verbose_name='Bookmarked by')
+    # no longer written, the views are logged in SongView. Kept until the
+    # existing rows are moved with the migrate_song_views command.
     viewedBy = models.ManyToManyField(User, related_name='viewed')
     content = models.TextField(default='')
     genre = models.CharField(max_length=3, choices=GENRE_CHOICES, default=ENTEXNO)
     video = models.URLField(blank=True)
     tabs = models.BooleanField('Contain tabs', default=False)
     published = models.BooleanField(default=False)
-    reg_date = models.DateTimeField('date registered', auto_now_add=True)
-    pub_date = models.DateTimeField('date published', null=True, blank=True)
+    reg_date = models.DateTimeField('date registered', auto_now_add=True,
+                                    db_index=True)
+    pub_date = models.DateTimeField('date published', null=True, blank=True,
+                                    db_index=True)
     mod_date = models.DateTimeField('last modified', auto_now=True)
     slug = models.SlugField(unique=True)
+    # computed from the content on save, see analyze_chords()
+    chord_mask = models.CharField(max_length=64, blank=True, editable=False)
+    key = models.CharField(max_length=3, blank=True, editable=False)
+    best_shift = models.SmallIntegerField('best semitone change', default=0,
+                                          editable=False)
+    barre_chords = models.PositiveSmallIntegerField(default=0, editable=False)
+    # number of SongView rows ever logged for the song, pruned ones included
+    view_count = models.PositiveIntegerField(default=0, editable=False)
+    # computed from the content on save, see index_minhash()
+    minhash = models.CharField(max_length=512, blank=True, editable=False)
+
+    objects = SongQuerySet.as_manager()
+
+    # the fields the search indexes and the cached search results depend on
+    SEARCH_FIELDS = ('title', 'content', 'genre', 'tabs', 'artist_id',
+                     'published')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        song = super(Song, cls).from_db(db, field_names, values)
+        song._stored_search_fields = song.search_fields()
+        # unpublishing through a plain save() must invalidate as much as
+        # publishing does
+        song._stored_published = song.__dict__.get('published', None)
+        # remember the stored content (unless deferred), so that save() can
+        # tell whether the lyrics index needs updating
+        song._indexed_content = song.__dict__.get('content', None)
+        # the same for the title and the name index
+        song._indexed_title = song.__dict__.get('title', None)
+        # and the stored artist, whose cached songs change along with it
+        song._stored_artist_id = song.__dict__.get('artist_id', None)
+        return song
 
     def save(self, slug_max_length=-1, *args, **kwargs):
         if self.id is None:
@@ -88,12 +227,53 @@ class Song(models.Model):
         self.content = strip_whitespace_lines(self.content)
         if self.video:
             self.video = self.get_embed_video_url()
+        self.analyze_chords()
+        content_changed = self.content != getattr(self, '_indexed_content', None)
+        if content_changed:
+            self.minhash = minhash_signature(self.content)
+        search_fields = self.search_fields()
+        search_changed = search_fields != getattr(
+                self, '_stored_search_fields', None)
 
         super(Song, self).save(*args, **kwargs)
 
+        if content_changed:
+            self.index_lyrics()
+            self.index_minhash()
+        if self.title != getattr(self, '_indexed_title', None):
+            NameWord.index(self, self.title)
+            self._indexed_title = self.title
+        MyCache.delete_sitemap_section('songs', self.id)
+        MyCache.bump_song_versions([self.slug])
+        page_tags = self.page_tags()
+        for artist_id in {self.artist_id, getattr(self, '_stored_artist_id', None)}:
+            if artist_id is not None:
+                MyCache.bump_generation(MyCache.Namespaces.ARTIST.format(artist_id))
+            if artist_id not in (None, self.artist_id):
+                # the page of the old artist still lists the song
+                page_tags.append(MyCache.Tags.ARTIST.format(artist_id))
+        MyCache.purge_pages(page_tags)
+        self._stored_artist_id = self.artist_id
+        self._stored_search_fields = search_fields
+        was_published = getattr(self, '_stored_published', None)
+        self._stored_published = self.published
+        if self.published or was_published:
+            if search_changed:
+                MyCache.bump_catalogue_version()
+            if self.published != was_published:
+                cache.delete(MyCache.Keys.PUBLISHED_SONGS_COUNT)
+            MyCache.delete_recent_songs()
+            MyCache.purge_pages(MyCache.Tags.SONG_LISTS)
+
+    def search_fields(self):
+        # deferred fields are left out, they count as changed
+        return tuple(self.__dict__.get(field, None)
+                     for field in self.SEARCH_FIELDS)
+
     def delete(self, *args, **kwargs):
         self.unpublish()
         super(Song, self).delete(*args, **kwargs)
+        MyCache.bump_song_versions([self.slug])
 
     def publish(self):
         self.published = True
@@ -101,6 +281,7 @@ class Song(models.Model):
         MyCache.incr_value(MyCache.Keys.PUBLISHED_SONGS_COUNT)
         MyCache.delete_recent_songs()
         self.save()
+        songs_published.send(sender=Song, song_ids=[self.id])
 
     def unpublish(self):
         self.published = False
@@ -108,6 +289,80 @@ class Song(models.Model):
         MyCache.decr_value(MyCache.Keys.PUBLISHED_SONGS_COUNT)
         MyCache.delete_recent_songs()
         self.save()
+        songs_unpublished.send(sender=Song, song_ids=[self.id])
+
+    def analyze_chords(self):
+        """
+        Compute the chord bitset, the key and the easiest semitone change of
+        the song, along with the number of barre chords it needs.
+        """
+        chords = extract_chords(self.content)
+        self.chord_mask = '{0:x}'.format(chords_mask(chords))
+        self.key = detect_key(chords)
+        self.best_shift, self.barre_chords = best_shift(chords)
+
+    def index_lyrics(self):
+        """
+        Replace the entries of the song in the lyrics index.
+        """
+        counts = Counter(word[:LyricsWord.WORD_MAX_LENGTH]
+                         for word in lyrics_words(self.content))
+        self.lyrics_words.all().delete()
+        LyricsWord.objects.bulk_create(
+            LyricsWord(word=word, song=self, count=min(count, 32767))
+            for word, count in counts.items())
+        self._indexed_content = self.content
+
+    def index_minhash(self):
+        """
+        Replace the LSH buckets of the song in the near-duplicate index.
+        """
+        self.minhash_bands.all().delete()
+        MinHashBand.objects.bulk_create(
+            MinHashBand(band=band, song=self)
+            for band in minhash_bands(self.minhash))
+
+    def probable_duplicates(self, songs=None, threshold=0.5, limit=10):
+        """
+        Return the songs that share an LSH bucket with this song and whose
+        estimated similarity is at least threshold, most similar first, with
+        the estimate set as their similarity attribute. The song does not
+        have to be saved.
+
+        Keyword arguments:
+        songs -- queryset of the songs to look into, all of them by default
+        """
+        signature = self.minhash or minhash_signature(self.content)
+        bands = minhash_bands(signature)
+        if not bands:
+            return []
+        if songs is None:
+            songs = Song.objects.all()
+        if self.id is not None:
+            songs = songs.exclude(id=self.id)
+
+        candidates = songs.filter(minhash_bands__band__in=bands).annotate(
+                buckets=Count('minhash_bands')).order_by('-buckets')
+        duplicates = []
+        for song in candidates.select_related('artist')[:limit * 5]:
+            song.similarity = minhash_similarity(signature, song.minhash)
+            if song.similarity >= threshold:
+                duplicates.append(song)
+        duplicates.sort(key=lambda song: song.similarity, reverse=True)
+        return duplicates[:limit]
+
+    def related_songs(self, limit=5):
+        return Song.objects.filter(
+                related_by__song=self, published=True
+                ).select_related('artist').order_by('-related_by__score')[:limit]
+
+    def page_tags(self):
+        """
+        Return the tags of the cached pages that show the song itself, that
+        is its page and the page of its artist.
+        """
+        return [MyCache.Tags.SONG.format(self.id),
+                MyCache.Tags.ARTIST.format(self.artist_id)]
 
     def get_embed_video_url(self):
         if 'www.youtube.com' in self.video:
@@ -152,6 +407,9 @@ class Song(models.Model):
             'genre'         : self.genre_str(),
             'video'         : self.video,
             'tabs'          : self.tabs,
+            'key'           : self.key,
+            'best_shift'    : self.best_shift,
+            'barre_chords'  : self.barre_chords,
             'registered'    : self.reg_date,
             'published'     : self.pub_date,
             'last_modified' : self.mod_date,
@@ -175,15 +433,328 @@ class Comment(models.Model):
     def save(self, *args, **kwargs):
         self.content = strip_whitespace_lines(self.content)
         super(Comment, self).save(*args, **kwargs)
+        MyCache.purge_pages([MyCache.Tags.SONG.format(self.song_id)])
+
+
+class RelatedSong(models.Model):
+    """
+    A song similar to another one, according to the users that viewed or
+    bookmarked both. Filled by the build_related_songs command.
+    """
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, related_name='+')
+    related = models.ForeignKey(Song, on_delete=models.CASCADE,
+                                related_name='related_by')
+    score = models.FloatField()
+
+
+class MinHashBand(models.Model):
+    """
+    An LSH bucket of the MinHash signature of a song. Songs that share a
+    bucket are candidates for being near-duplicates of each other.
+    """
+    band = models.CharField(max_length=40, db_index=True)
+    song = models.ForeignKey(Song, on_delete=models.CASCADE,
+                             related_name='minhash_bands')
+
+    @classmethod
+    def duplicate_pairs(cls, threshold=0.5):
+        """
+        Return (similarity, song, other song) for all the pairs of songs
+        whose estimated similarity is at least threshold, most similar first.
+        """
+        shared = cls.objects.values('band').annotate(
+                songs=Count('id')).filter(songs__gt=1).values('band')
+        rows = cls.objects.filter(band__in=shared).order_by(
+                'band', 'song').values_list('band', 'song')
+
+        pairs = set()
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            song_ids = [song_id for _, song_id in group]
+            pairs.update(itertools.combinations(song_ids, 2))
+
+        songs = Song.objects.select_related('artist').in_bulk(
+                {song_id for pair in pairs for song_id in pair})
+        duplicates = []
+        for id1, id2 in pairs:
+            similarity = minhash_similarity(songs[id1].minhash,
+                                            songs[id2].minhash)
+            if similarity >= threshold:
+                duplicates.append((similarity, songs[id1], songs[id2]))
+        duplicates.sort(key=lambda pair: (-pair[0], pair[1].id, pair[2].id))
+        return duplicates
+
+
+class SongView(models.Model):
+    """
+    Append-only log of the days on which users viewed songs, with at most one
+    row per user, song and day. The log is partitioned by day: whole days
+    older than the retention period are dropped by the prune command,
+    while the per-song totals live on in Song.view_count.
+    """
+    RETENTION_DAYS = 90
+
+    song = models.ForeignKey(Song, on_delete=models.CASCADE,
+                             related_name='view_log')
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='song_views')
+    day = models.DateField(db_index=True)
+
+    objects = ExpiringQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('song', 'user', 'day')
+
+    @classmethod
+    def record(cls, song_id, user):
+        """
+        Log that the user viewed the song today and return whether this is
+        the first view of the day.
+        """
+        try:
+            with transaction.atomic():
+                cls.objects.create(song_id=song_id, user=user,
+                                   day=timezone.now().date())
+        except IntegrityError:
+            return False
+        Song.objects.filter(id=song_id).update(view_count=F('view_count') + 1)
+        return True
+
+    @classmethod
+    def prune(cls, days=RETENTION_DAYS, now=None):
+        """
+        Delete the days of the log older than days and return the number of
+        deleted rows.
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(
+                day__lt=(now - datetime.timedelta(days=days)).date()).prune()
+
+
+class SongViewBucket(models.Model):
+    """
+    The number of times a song was viewed during an hour. Buckets older than
+    RETENTION are pruned by the rollup_trending and prune commands, since
+    their weight in the trending scores is negligible.
+    """
+    # the weight of a view halves every HALF_LIFE
+    HALF_LIFE = datetime.timedelta(hours=24)
+    RETENTION = datetime.timedelta(days=7)
+
+    song = models.ForeignKey(Song, on_delete=models.CASCADE,
+                             related_name='view_buckets')
+    hour = models.DateTimeField(db_index=True)
+    views = models.PositiveIntegerField(default=0)
+
+    objects = ExpiringQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('song', 'hour')
+
+    @classmethod
+    def record(cls, song_id):
+        """
+        Count a view of the song in the bucket of the current hour.
+        """
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        buckets = cls.objects.filter(song_id=song_id, hour=hour)
+        if buckets.update(views=F('views') + 1):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(song_id=song_id, hour=hour, views=1)
+        except IntegrityError:
+            # another request created the bucket in the meantime
+            buckets.update(views=F('views') + 1)
+
+    @classmethod
+    def trending(cls, limit=100, now=None):
+        """
+        Return the ids of the published songs with the highest exponentially
+        decayed view counts, along with their scores, highest first.
+        """
+        now = now or timezone.now()
+        half_life = cls.HALF_LIFE.total_seconds()
+        rows = cls.objects.filter(
+                hour__gte=now - cls.RETENTION, song__published=True
+                ).values_list('song', 'hour', 'views')
+
+        scores = Counter()
+        for song_id, hour, views in rows.iterator():
+            age = max((now - hour).total_seconds(), 0)
+            scores[song_id] += views * math.pow(0.5, age / half_life)
+        return [(song_id, score) for song_id, score in scores.most_common(limit)]
+
+    @classmethod
+    def prune(cls, now=None):
+        """
+        Delete the buckets older than RETENTION and return their number.
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(hour__lt=now - cls.RETENTION).prune()
+
+
+class SongDraft(models.Model):
+    """
+    A song submitted through the add song form but not yet confirmed by its
+    sender. Only the id of the draft is kept in the session, so the session
+    rows stay small however long the song is. Drafts left behind expire
+    after TTL and are deleted by the prune command.
+    """
+    TTL = datetime.timedelta(days=1)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='song_drafts')
+    data = models.TextField()
+    mod_date = models.DateTimeField(auto_now=True)
+
+    objects = ExpiringQuerySet.as_manager()
+
+    def get_data(self):
+        return json.loads(self.data)
+
+    def set_data(self, data):
+        self.data = json.dumps(data)
+
+    @classmethod
+    def get_live(cls, draft_id, user):
+        """
+        Return the draft of the user with the given id, or None if it does
+        not exist or has expired.
+        """
+        try:
+            return cls.objects.get(id=draft_id, user=user,
+                                   mod_date__gte=timezone.now() - cls.TTL)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def prune(cls, now=None):
+        """
+        Delete the expired drafts and return their number.
+        """
+        now = now or timezone.now()
+        return cls.objects.filter(mod_date__lt=now - cls.TTL).prune()
+
+
+class LyricsWord(models.Model):
+    """
+    Inverted index of the lyrics. There is one row for every distinct word
+    of each song, holding the number of its occurrences in the song.
+    """
+    WORD_MAX_LENGTH = 40
+
+    word = models.CharField(max_length=WORD_MAX_LENGTH, db_index=True)
+    song = models.ForeignKey(Song, on_delete=models.CASCADE,
+                             related_name='lyrics_words')
+    count = models.PositiveSmallIntegerField(default=1)
+
+    @classmethod
+    def search(cls, query, limit=100):
+        """
+        Return the ids of up to limit published songs whose lyrics contain
+        any of the words of the query. Songs matching more distinct words
+        come first, then songs with more occurrences of them.
+        """
+        words = {word[:cls.WORD_MAX_LENGTH] for word in lyrics_words(query)}
+        if not words:
+            return []
+        rows = cls.objects.filter(
+                word__in=words, song__published=True
+                ).values('song').annotate(
+                matched=Count('id'), occurrences=Sum('count')
+                ).order_by('-matched', '-occurrences', 'song')[:limit]
+        return [row['song'] for row in rows]
+
+
+class NameWord(models.Model):
+    """
+    Word level index of the song titles and the artist names, used by the
+    admin search. There is one row for every distinct greeklish normalized
+    word of each name, so that looking up a word prefix is an index range
+    scan and matches whichever latin spelling of a greek word is used.
+    """
+    WORD_MAX_LENGTH = 40
+
+    word = models.CharField(max_length=WORD_MAX_LENGTH, db_index=True)
+    song = models.ForeignKey(Song, on_delete=models.CASCADE, null=True,
+                             related_name='name_words')
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, null=True,
+                               related_name='name_words')
+
+    @classmethod
+    def words(cls, name):
+        return {word[:cls.WORD_MAX_LENGTH]
+                for word in greeklish_normalize(name).split()}
+
+    @classmethod
+    def index(cls, obj, name):
+        """
+        Replace the entries of a song or an artist with the words of name.
+        """
+        field = 'song' if isinstance(obj, Song) else 'artist'
+        obj.name_words.all().delete()
+        cls.objects.bulk_create(cls(word=word, **{field : obj})
+                                for word in cls.words(name))
+
+    @classmethod
+    def ids_starting_with(cls, field, prefix):
+        """
+        Return the ids of the songs or the artists (field is 'song' or
+        'artist') having a word that starts with the given word, as a
+        queryset to filter with.
+        """
+        return cls.objects.filter(word__startswith=prefix).exclude(
+                **{field : None}).values_list(field, flat=True)
 
 
 class MyCache:
+    # number of consecutive ids that share a sitemap section
+    SITEMAP_SECTION_SIZE = 5000
+    # number of songs remembered per user, see add_recently_viewed()
+    RECENTLY_VIEWED_SIZE = 20
+    # songs kept in the memory of each process, see song()
+    HOT_SONGS = LRUCache(maxsize=500)
+    # generations of the process, when the cache keeps nothing (the dummy
+    # cache of development), see generation()
+    LOCAL_GENERATIONS = {}
+
     class Keys:
         PUBLISHED_SONGS_COUNT = 'published_songs_count'
         ARTISTS_COUNT = 'artists_count'
         USER_COUNT = 'users_count'
         MOST_POPULAR_SONGS = 'most_popular_songs'
         MOST_RECENT_SONGS = 'most_recent_songs'
+        SITEMAP_SECTION = 'sitemap_{0}_{1}'
+        GENERATION = 'generation_{0}'
+        SEARCH_RESULTS = 'search_results_{0}'
+        USER_BOOKMARKS = 'user_bookmarks_{0}'
+        TRENDING_RANKING = 'trending_ranking'
+        TRENDING_SONGS = 'trending_songs'
+        RECENTLY_VIEWED = 'recently_viewed_{0}'
+        ARTIST_SONGS = 'artist_songs_{0}'
+        HOMEPAGE = 'homepage'
+        PAGE = 'page_{0}'
+        SONG = 'song_{0}'
+        SONG_VERSION = 'song_version_{0}'
+        PAGE_TAG = 'page_tag_{0}'
+
+    # families of keys that are invalidated together, see namespaced()
+    class Namespaces:
+        CATALOGUE = 'catalogue'
+        USERNAMES = 'usernames'
+        ARTIST = 'artist:{0}'
+        USER = 'user:{0}'
+
+    # what the cached anonymous pages depend on, see cached_page()
+    class Tags:
+        SONG = 'song_{0}'
+        ARTIST = 'artist_{0}'
+        INDEX = 'index'
+        POPULAR = 'popular'
+        RECENTLY_ADDED = 'recently_added'
+        TRENDING = 'trending'
+        # the lists of songs, which show their titles and artist names
+        SONG_LISTS = [INDEX, POPULAR, RECENTLY_ADDED, TRENDING]
 
     def popular_songs():
         key = MyCache.Keys.MOST_POPULAR_SONGS
@@ -191,13 +762,30 @@ class MyCache:
         if songs is None:
             # print("DB READ - most popular songs")
             songs = Song.objects.filter(published=True).annotate(
-                    popularity=Count('viewedBy') + 2 * Count('bookmarkedBy')
+                    popularity=F('view_count') + 2 * Count('bookmarkedBy')
                     ).order_by('-popularity')
 
             # cache the result for a day
             cache.set(key, songs, 86400)
         return songs
 
+    def artist_songs(artist):
+        """
+        Return the slugs and the titles of the published songs of the artist,
+        ordered by title, as dicts. Only what the artist page shows is kept,
+        so that the songs of prolific artists still fit in a cache item.
+        """
+        key = MyCache.namespaced(MyCache.Keys.ARTIST_SONGS.format(artist.id),
+                                 MyCache.Namespaces.ARTIST.format(artist.id))
+        songs = cache.get(key, None)
+        if songs is None:
+            # print("DB READ - artist songs")
+            songs = artist.songs.filter(published=True).order_by('title').only(
+                    'title', 'slug', 'tabs')
+            songs = [{'slug' : song.slug, 'title' : str(song)} for song in songs]
+            cache.set(key, songs, 86400)
+        return songs
+
     def recent_songs():
         key = MyCache.Keys.MOST_RECENT_SONGS
         songs = cache.get(key, None)
@@ -207,8 +795,329 @@ class MyCache:
             cache.set(key, songs)
         return songs
 
+    def trending_songs():
+        """
+        Return the trending published songs, most trending first. The ranking
+        is refreshed by the rollup_trending command and computed here only
+        when it is missing from the cache.
+        """
+        songs = cache.get(MyCache.Keys.TRENDING_SONGS, None)
+        if songs is None:
+            ranking = cache.get(MyCache.Keys.TRENDING_RANKING, None)
+            if ranking is None:
+                ranking = MyCache.update_trending_songs()
+            # print("DB READ - trending songs")
+            in_bulk = Song.objects.filter(published=True).select_related(
+                    'artist').in_bulk([song_id for song_id, _ in ranking])
+            songs = [in_bulk[song_id] for song_id, _ in ranking
+                     if song_id in in_bulk]
+            cache.set(MyCache.Keys.TRENDING_SONGS, songs, 7200)
+        return songs
+
+    def update_trending_songs():
+        ranking = SongViewBucket.trending()
+        # the rollup runs hourly, keep the ranking a bit longer than that
+        cache.set(MyCache.Keys.TRENDING_RANKING, ranking, 7200)
+        cache.delete(MyCache.Keys.TRENDING_SONGS)
+        MyCache.purge_pages([MyCache.Tags.TRENDING])
+        return ranking
+
     def delete_recent_songs():
-        cache.delete(MyCache.Keys.MOST_RECENT_SONGS)
+        # the trending songs too, they are cached along with their titles
+        cache.delete_many([MyCache.Keys.MOST_RECENT_SONGS,
+                           MyCache.Keys.TRENDING_SONGS,
+                           MyCache.Keys.HOMEPAGE])
+
+    def homepage():
+        """
+        Return the snapshot of everything the index page shows: the recent
+        and the most popular songs as (slug, full title) rows, and the counts
+        of songs, artists and users.
+        """
+        snapshot = cache.get(MyCache.Keys.HOMEPAGE, None)
+        if snapshot is None:
+            snapshot = MyCache.rebuild_homepage()
+        return snapshot
+
+    def rebuild_homepage():
+        def rows(songs):
+            return [{'slug' : song.slug, 'full_title' : song.full_title()}
+                    for song in songs]
+
+        recent = Song.objects.filter(published=True).select_related(
+                'artist').order_by('-pub_date')[:7]
+        popular_ids = [song.id for song in MyCache.popular_songs()[:7]]
+        popular = Song.objects.select_related('artist').in_bulk(popular_ids)
+        snapshot = {
+            'recent_songs' : rows(recent),
+            'popular_songs' : rows(popular[song_id] for song_id in popular_ids
+                                   if song_id in popular),
+            'song_count' : MyCache.published_songs_count(),
+            'artist_count' : MyCache.artists_count(),
+            'user_count' : MyCache.users_count(),
+        }
+        # rebuilt when songs get published, only expires so that the popular
+        # songs and the counts do not drift for long
+        cache.set(MyCache.Keys.HOMEPAGE, snapshot, 3600)
+        return snapshot
+
+    def delete_homepage():
+        cache.delete(MyCache.Keys.HOMEPAGE)
+
+    def delete_sitemap_section(section, obj_id):
+        page = obj_id // MyCache.SITEMAP_SECTION_SIZE + 1
+        cache.delete(MyCache.Keys.SITEMAP_SECTION.format(section, page))
+
+    def delete_sitemap_sections(section, obj_ids):
+        pages = {obj_id // MyCache.SITEMAP_SECTION_SIZE + 1 for obj_id in obj_ids}
+        cache.delete_many([MyCache.Keys.SITEMAP_SECTION.format(section, page)
+                           for page in pages])
+
+    def generation(namespace):
+        """
+        Return the current generation of a namespace of keys. Generations
+        start from a random number, so that a namespace whose counter got
+        evicted never goes back to a generation that is still in the cache.
+        """
+        key = MyCache.Keys.GENERATION.format(namespace)
+        generation = cache.get(key, None)
+        if generation is None:
+            cache.add(key, random.getrandbits(63), None)
+            generation = cache.get(key, None)
+        if generation is None:
+            # a new generation on every call would rebuild the in-process
+            # indexes on every search
+            generation = MyCache.LOCAL_GENERATIONS.setdefault(
+                    namespace, random.getrandbits(63))
+        return generation
+
+    def bump_generation(namespace):
+        """
+        Invalidate all the keys of a namespace at once. Their entries are
+        never read again and simply expire.
+        """
+        MyCache.LOCAL_GENERATIONS.pop(namespace, None)
+        try:
+            cache.incr(MyCache.Keys.GENERATION.format(namespace))
+        except ValueError:
+            # no generation yet, the next one will be a new random number
+            pass
+
+    def namespaced(key, *namespaces):
+        """
+        Return the key stamped with the current generations of the namespaces.
+        """
+        generations = cache.get_many(
+                [MyCache.Keys.GENERATION.format(ns) for ns in namespaces])
+        stamps = []
+        for namespace in namespaces:
+            generation = generations.get(
+                    MyCache.Keys.GENERATION.format(namespace), None)
+            if generation is None:
+                generation = MyCache.generation(namespace)
+            stamps.append(str(generation))
+        return '_'.join([key] + stamps)
+
+    def catalogue_version():
+        """
+        Return the current version of the catalogue, which changes whenever
+        the searchable fields of the published songs or the artists change.
+        The in-process search indexes and the cached search results are
+        stamped with it.
+        """
+        return MyCache.generation(MyCache.Namespaces.CATALOGUE)
+
+    def bump_catalogue_version():
+        MyCache.bump_generation(MyCache.Namespaces.CATALOGUE)
+
+    def usernames_version():
+        """
+        Like catalogue_version(), for the usernames, which change far more
+        often than the catalogue as users sign up.
+        """
+        return MyCache.generation(MyCache.Namespaces.USERNAMES)
+
+    def bump_usernames_version():
+        MyCache.bump_generation(MyCache.Namespaces.USERNAMES)
+
+    def search_results(query, find, namespace=Namespaces.CATALOGUE):
+        """
+        Return the ids of the results of a search, from the cache if the
+        searched namespace did not change since they were found.
+
+        Keyword arguments:
+        query     -- tuple of the normalized search parameters
+        find      -- callable returning the ids, called on a cache miss
+        namespace -- CATALOGUE, or USERNAMES for user searches
+        """
+        digest = hashlib.md5(repr(query).encode('utf-8')).hexdigest()
+        key = MyCache.namespaced(MyCache.Keys.SEARCH_RESULTS.format(digest),
+                                 namespace)
+        ids = cache.get(key, None)
+        if ids is None:
+            ids = find()
+            cache.set(key, ids, 3600)
+        return ids
+
+    def user_key(key, user):
+        """
+        Return the key of a cache entry of the user, which goes away along
+        with all the others when the user namespace is bumped.
+        """
+        return MyCache.namespaced(key.format(user.id),
+                                  MyCache.Namespaces.USER.format(user.id))
+
+    def bookmarked_song_ids(user):
+        """
+        Return a SortedIdSet with the ids of the songs bookmarked by the user.
+        """
+        key = MyCache.user_key(MyCache.Keys.USER_BOOKMARKS, user)
+        song_ids = cache.get(key, None)
+        if song_ids is None:
+            # print("DB READ - user bookmarks")
+            song_ids = SortedIdSet(user.bookmarks.values_list('id', flat=True))
+            cache.set(key, song_ids)
+        return song_ids
+
+    def delete_bookmarks(user):
+        cache.delete(MyCache.user_key(MyCache.Keys.USER_BOOKMARKS, user))
+
+    # the cached set is dropped rather than updated in place, so that
+    # concurrent toggles cannot lose each other's changes
+    def add_bookmarks(user, songs):
+        user.bookmarks.add(*songs)
+        MyCache.delete_bookmarks(user)
+
+    def remove_bookmarks(user, songs):
+        user.bookmarks.remove(*songs)
+        MyCache.delete_bookmarks(user)
+
+    def recently_viewed_song_ids(user):
+        """
+        Return the ids of the last songs viewed by the user, most recent first.
+        """
+        key = MyCache.user_key(MyCache.Keys.RECENTLY_VIEWED, user)
+        return list(cache.get(key, ()))
+
+    def add_recently_viewed(user, song_id):
+        """
+        Push the song to the front of the bounded buffer of the songs viewed
+        by the user, dropping the oldest one when the buffer is full.
+        """
+        key = MyCache.user_key(MyCache.Keys.RECENTLY_VIEWED, user)
+        song_ids = cache.get(key, None)
+        if song_ids is None:
+            song_ids = deque(maxlen=MyCache.RECENTLY_VIEWED_SIZE)
+        if song_ids and song_ids[0] == song_id:
+            return
+        if song_id in song_ids:
+            song_ids.remove(song_id)
+        song_ids.appendleft(song_id)
+        # remember the songs for a month of inactivity
+        cache.set(key, song_ids, 2592000)
+
+    def song(slug):
+        """
+        Return the song of the slug, published or not, or None if there is no
+        such song. Songs are looked up in the memory of the process first,
+        then in the shared cache and only then in the database. Each song has
+        a version, changed by bump_song_versions() whenever it changes, so an
+        outdated copy is never returned. The songs kept in memory are shared
+        by all the threads of the process and must not be modified.
+        """
+        version_key = MyCache.Keys.SONG_VERSION.format(slug)
+        version = cache.get(version_key, None)
+        if version is None:
+            cache.add(version_key, uuid.uuid4().hex, None)
+            version = cache.get(version_key, None)
+
+        if version is not None:
+            cached = MyCache.HOT_SONGS.get(slug, None)
+            if cached is None or cached[0] != version:
+                cached = cache.get(MyCache.Keys.SONG.format(slug), None)
+            if cached is not None and cached[0] == version:
+                MyCache.HOT_SONGS.set(slug, cached)
+                return cached[1]
+
+        # print("DB READ - song")
+        try:
+            song = Song.objects.select_related('artist', 'sender').get(slug=slug)
+        except Song.DoesNotExist:
+            return None
+        if version is not None:
+            MyCache.HOT_SONGS.set(slug, (version, song))
+            cache.set(MyCache.Keys.SONG.format(slug), (version, song), 86400)
+        return song
+
+    def bump_song_versions(slugs):
+        cache.delete_many([MyCache.Keys.SONG_VERSION.format(slug)
+                           for slug in slugs])
+
+    def purge_song(song_id, slug, artist_ids):
+        """
+        Invalidate everything cached about a song and the lists it may be in.
+        Song.save() does so before the transaction around it commits, when a
+        concurrent request can still cache the old row under the new
+        versions, so views saving songs in a transaction call this once more
+        after the commit.
+        """
+        artist_ids = [artist_id for artist_id in artist_ids
+                      if artist_id is not None]
+        MyCache.bump_song_versions([slug])
+        for artist_id in artist_ids:
+            MyCache.bump_generation(MyCache.Namespaces.ARTIST.format(artist_id))
+        MyCache.bump_catalogue_version()
+        MyCache.delete_recent_songs()
+        MyCache.purge_pages(
+            [MyCache.Tags.SONG.format(song_id)] +
+            [MyCache.Tags.ARTIST.format(artist_id) for artist_id in artist_ids] +
+            MyCache.Tags.SONG_LISTS)
+
+    def page_tag_versions(tags):
+        """
+        Return a dict with the current version of each tag, creating the
+        missing ones. A page stores the versions of its tags taken before it
+        was rendered, so that a purge during the rendering is not missed.
+        """
+        keys = {tag : MyCache.Keys.PAGE_TAG.format(tag) for tag in tags}
+        current = cache.get_many(list(keys.values()))
+        versions = {}
+        for tag, key in keys.items():
+            version = current.get(key, None)
+            if version is None:
+                cache.add(key, uuid.uuid4().hex, None)
+                version = cache.get(key, None)
+            versions[tag] = version
+        return versions
+
+    def cached_page(path):
+        """
+        Return the (content, content type, hit arguments) of the cached page
+        of the path, or None if it is missing or any of its tags got purged
+        since it was cached.
+        """
+        digest = hashlib.md5(path.encode('utf-8')).hexdigest()
+        page = cache.get(MyCache.Keys.PAGE.format(digest), None)
+        if page is None:
+            return None
+        content, content_type, versions, hit_args = page
+        keys = {tag : MyCache.Keys.PAGE_TAG.format(tag) for tag in versions}
+        current = cache.get_many(list(keys.values()))
+        for tag, version in versions.items():
+            if version is None or current.get(keys[tag], None) != version:
+                return None
+        return content, content_type, hit_args
+
+    def cache_page(path, content, content_type, versions, hit_args=()):
+        digest = hashlib.md5(path.encode('utf-8')).hexdigest()
+        cache.set(MyCache.Keys.PAGE.format(digest),
+                  (content, content_type, versions, hit_args), 3600)
+
+    def purge_pages(tags):
+        """
+        Invalidate all the cached pages that depend on any of the tags.
+        """
+        cache.delete_many([MyCache.Keys.PAGE_TAG.format(tag) for tag in tags])
 
     def published_songs_count():
         key = MyCache.Keys.PUBLISHED_SONGS_COUNT
@@ -237,14 +1146,47 @@ class MyCache:
             cache.set(key, count)
         return count
 
-    def incr_value(key):
+    def incr_value(key, delta=1):
         try:
-            cache.incr(key)
+            cache.incr(key, delta)
         except ValueError:
             pass
 
-    def decr_value(key):
+    def decr_value(key, delta=1):
         try:
-            cache.decr(key)
+            cache.decr(key, delta)
         except ValueError:
             pass
+
+
+@receiver([songs_published, songs_unpublished])
+def songs_published_or_unpublished(sender, song_ids, **kwargs):
+    MyCache.bump_catalogue_version()
+    songs = Song.objects.filter(id__in=song_ids).values_list('slug', 'artist_id')
+    MyCache.bump_song_versions([slug for slug, _ in songs])
+    artist_ids = {artist_id for _, artist_id in songs}
+    for artist_id in artist_ids:
+        MyCache.bump_generation(MyCache.Namespaces.ARTIST.format(artist_id))
+    MyCache.purge_pages(
+        [MyCache.Tags.SONG.format(song_id) for song_id in song_ids] +
+        [MyCache.Tags.ARTIST.format(artist_id) for artist_id in artist_ids] +
+        MyCache.Tags.SONG_LISTS)
+    MyCache.rebuild_homepage()
+
+@receiver(post_save, sender=User)
+def user_saved(sender, created, update_fields, **kwargs):
+    # logins only save the last_login field
+    if not update_fields or 'username' in update_fields:
+        MyCache.bump_usernames_version()
+    if created:
+        MyCache.incr_value(MyCache.Keys.USER_COUNT)
+        MyCache.delete_homepage()
+        MyCache.purge_pages([MyCache.Tags.INDEX])
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    MyCache.decr_value(MyCache.Keys.USER_COUNT)
+    MyCache.bump_usernames_version()
+    MyCache.delete_homepage()
+    MyCache.bump_generation(MyCache.Namespaces.USER.format(instance.id))
+    MyCache.purge_pages([MyCache.Tags.INDEX])
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# Sent once for every batch of songs that got published or unpublished, with
+# the ids of the affected songs, so that receivers such as search indexes can
+# update themselves in one go.
+songs_published = Signal(providing_args=['song_ids'])
+songs_unpublished = Signal(providing_args=['song_ids'])
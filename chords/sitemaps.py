@@ -1,7 +1,54 @@
 from django.contrib import sitemaps
+from django.contrib.sitemaps.views import x_robots_tag, sitemap as sitemap_view
 from django.core.urlresolvers import reverse
-
-from .models import Artist, Song, User
+from django.core.paginator import Page, EmptyPage, PageNotAnInteger
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse
+from django.utils.functional import cached_property
+
+from .models import Artist, Song, User, MyCache
+
+
+class KeysetPaginator:
+    """
+    Splits a queryset into numbered sections of consecutive primary keys.
+    Section n holds the objects with (n - 1) * per_page <= pk < n * per_page,
+    so every section is fetched with an index range scan instead of an
+    OFFSET query and an object never moves to another section.
+    """
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    @cached_property
+    def num_pages(self):
+        max_id = self.queryset.aggregate(max_id=Max('id'))['max_id'] or 0
+        return max_id // self.per_page + 1
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1 or number > self.num_pages:
+            raise EmptyPage('That page contains no results')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        low = (number - 1) * self.per_page
+        object_list = self.queryset.filter(
+                id__gte=low, id__lt=low + self.per_page).order_by('id')
+        return Page(object_list, number, self)
+
+
+class KeysetSitemap(sitemaps.Sitemap):
+    limit = MyCache.SITEMAP_SECTION_SIZE
+
+    def _get_paginator(self):
+        return KeysetPaginator(self.items(), self.limit)
+    paginator = property(_get_paginator)
 
 
 class StaticViewSitemap(sitemaps.Sitemap):
@@ -9,37 +56,63 @@ class StaticViewSitemap(sitemaps.Sitemap):
     priority = 0.5
 
     def items(self):
-        return ['index', 'popular', 'recently_added', 'search', 'contact']
+        return ['index', 'popular', 'trending', 'recently_added', 'search', 'contact']
 
     def location(self, item):
         return reverse('chords:' + item)
 
 
-class SongSitemap(sitemaps.Sitemap):
+class SongSitemap(KeysetSitemap):
     changefreq = "weekly"
     priority = 0.5
 
     def items(self):
-        return Song.objects.filter(published=True)
+        return Song.objects.filter(published=True).only('slug', 'mod_date')
 
     def lastmod(self, obj):
         return obj.mod_date
 
 
-class ArtistSitemap(sitemaps.Sitemap):
+class ArtistSitemap(KeysetSitemap):
     changefreq = "weekly"
     priority = 0.5
 
     def items(self):
-        return Artist.objects.all()
+        return Artist.objects.only('slug')
 
 
-class UserSitemap(sitemaps.Sitemap):
+class UserSitemap(KeysetSitemap):
     changefreq = "monthly"
     priority = 0.5
 
     def items(self):
-        return User.objects.all()
+        return User.objects.only('username')
 
     def location(self, user):
         return reverse('chords:user', args=(user.get_username(),))
+
+
+@x_robots_tag
+def cached_sitemap(request, sitemaps, section):
+    """
+    Serve a sitemap section from the cache, rendering it only on a miss.
+    Song and artist sections are invalidated when an object in their range
+    changes, the rest simply expire.
+    """
+    page = request.GET.get('p', '1')
+    if not page.isdigit():
+        # let the sitemap view respond with the appropriate 404
+        return sitemap_view(request, sitemaps, section=section)
+
+    key = MyCache.Keys.SITEMAP_SECTION.format(section, int(page))
+    cached = cache.get(key, None)
+    if cached is None:
+        response = sitemap_view(request, sitemaps, section=section).render()
+        cached = (response.content, response.get('Last-Modified', None))
+        cache.set(key, cached, 86400)
+
+    content, last_modified = cached
+    response = HttpResponse(content, content_type='application/xml')
+    if last_modified is not None:
+        response['Last-Modified'] = last_modified
+    return response
@@ -0,0 +1,43 @@
+$(function() {
+
+var lastQuery = '';
+
+/**
+ * Perform an AJAX GET request to get suggestions for the navbar search box
+ * and display them as a dropdown menu below it.
+ */
+$('#navbar_search').keyup(function() {
+    var query = $.trim($(this).val());
+    if (query == lastQuery)
+        return;
+    lastQuery = query;
+
+    if (!query) {
+        $('#autocomplete_menu').empty().hide();
+        return;
+    }
+
+    $.get($(this).attr('data-autocomplete-url'), {q : query}, function(data) {
+        // ignore responses to outdated queries
+        if (query != lastQuery)
+            return;
+
+        var menu = $('#autocomplete_menu').empty();
+        $.each(data.results, function(i, result) {
+            menu.append($('<li></li>').append(
+                $('<a></a>').attr('href', result.url)
+                            .text(result.name + ' (' + result.type + ')')));
+        });
+        if (data.results.length)
+            menu.show();
+        else
+            menu.hide();
+    });
+});
+
+$('#navbar_search').blur(function() {
+    // give the browser time to follow a clicked suggestion
+    setTimeout(function() { $('#autocomplete_menu').hide(); }, 200);
+});
+
+});
@@ -149,7 +149,8 @@ $('#contact_form').submit(function(event) {
 /**
  * After validating the form, perform an AJAX POST request in order to save
  * the new comment in the database and append it to the page. After
- * successfully posting a comment, ignore the recaptcha field.
+ * successfully posting a comment, hide the recaptcha field, the server does
+ * not ask for it again during the session.
  */
 $('#comment_form').submit(function(event) {
     event.preventDefault();
@@ -165,9 +166,7 @@ $('#comment_form').submit(function(event) {
         content : $('#id_content').val(),
     };
 
-    if ($('.g-recaptcha').css('display') == 'none')
-        data['testing'] = 'True';
-    else
+    if ($('.g-recaptcha').css('display') != 'none')
         data['g-recaptcha-response'] = $('#g-recaptcha-response').val();
 
     var url = $('#comment_form').attr('action');
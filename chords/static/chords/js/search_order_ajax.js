@@ -1,5 +1,13 @@
 $(function() {
 
+/**
+ * Return the url with its orderBy parameter set to orderBy.
+ */
+function withOrderBy(url, orderBy) {
+    url = url.replace(/([?&])orderBy=[^&#]*&?/, '$1').replace(/[?&]$/, '');
+    return url + (url.indexOf('?') == -1 ? '?' : '&') + 'orderBy=' + orderBy;
+}
+
 /**
  * Perform an AJAX GET request to get sorted search results.
  */
@@ -31,10 +39,14 @@ $('#search_table th a').click(function() {
 
     $('#id_orderBy').attr('value', orderByNew);
 
-    url = window.location.href;
-    $.get(url, {orderBy : orderByNew}, function(data) {
+    $.get(withOrderBy(window.location.href, orderByNew), function(data) {
         $('#search_table tbody').html(data);
     });
+
+    // keep the order when moving to another page of the results
+    $('.pager a').attr('href', function(i, href) {
+        return withOrderBy(href, orderByNew);
+    });
 });
 
 });
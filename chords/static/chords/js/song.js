@@ -31,6 +31,27 @@ $('#semiton_change').change(function() {
     });
 });
 
+/**
+ * The song page is the same for everyone, so that it can be cached. Fetch
+ * the state of the current user and fill in the personalized parts: the
+ * navbar menu, the bookmark link and the comment form.
+ */
+var userStateUrl = $('#song_user_state').attr('data-url');
+if (userStateUrl)
+    $.get(userStateUrl, function(data) {
+        if (!data.user)
+            return;
+
+        $('#navbar_user').html(data.navbar);
+        $('#bookmark').text(data.bookmarked ? '(-) Remove from bookmarks'
+                                            : '(+) Add to bookmarks');
+        $('#bookmark_row').show();
+        $('#comment_form [name="csrfmiddlewaretoken"]').attr('value', data.csrf_token);
+        $('#id_user').attr('value', data.user.id);
+        $('#comment_login').hide();
+        $('#comment_form').show();
+    });
+
 /**
  * Perform an AJAX request to bookmark or unbookmark a song.
  */
@@ -204,25 +225,25 @@ function parseSong() {
 
 /**
  * Fills the semiton_change select object, with the values from -5 to 6
- * followed by the base chord of the song at the specific semiton.
+ * followed by the key of the song at the specific semiton. The key is
+ * detected on the server, falling back to the first chord of the song. The
+ * semiton change that needs the fewest barre chords is marked as easiest.
  *
  * eg. -1 (D), 0 (D#), +1 (E)
  */
 function fillSemitonChange() {
-    var songBase = $('.chord').first().attr('origchord');
+    var select = $('#semiton_change');
+    var songBase = select.attr('data-key') || $('.chord').first().attr('origchord');
     if (! songBase)
         return;
+    var bestShift = parseInt(select.attr('data-best-shift'), 10) || 0;
     for (i = 6; i >= -5; i--) {
-        if (i != 0) {
-            $('#semiton_change')
-                .append($('<option></option>')
-                .text((i>0 ? '+' : '') + i + ' (' + changeSemiton(songBase, i) + ')'));
-        } else {
-            $('#semiton_change')
-                .append($('<option></option>')
-                .attr('selected', 'selected')
-                .text(i + ' (' + changeSemiton(songBase, i) + ')'));
-        }
+        var option = $('<option></option>')
+            .text((i>0 ? '+' : '') + i + ' (' + changeSemiton(songBase, i) + ')' +
+                  (i == bestShift && i != 0 ? ' easiest' : ''));
+        if (i == 0)
+            option.attr('selected', 'selected');
+        select.append(option);
     }
 }
 
@@ -50,6 +50,15 @@ class AddCommentFormTests(TestCase):
         """
         self.assertTrue(AddCommentForm(self.valid_data).is_valid())
 
+    def test_form_without_captcha(self):
+        """
+        Form must not need a captcha answer when it is not required.
+        """
+        data = self.valid_data.copy()
+        del data['g-recaptcha-response']
+        self.assertFalse(AddCommentForm(data).is_valid())
+        self.assertTrue(AddCommentForm(data, require_captcha=False).is_valid())
+
     def test_form_with_invalid_data(self):
         """
         Test form with invalid data.
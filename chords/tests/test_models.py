@@ -1,7 +1,17 @@
 from django.test import TestCase
 from django.utils import timezone
+from django.core.management import call_command
+from django.core.cache import cache
+from django.conf import settings
+from django.test.utils import override_settings
 
-from chords.models import Artist, Song
+import datetime
+from io import StringIO
+
+from chords.models import (Artist, Song, SongView, LyricsWord, RelatedSong,
+                           MinHashBand, MyCache)
+from chords.management.commands import build_related_songs
+from chords.signals import songs_published, songs_unpublished
 from .helper_functions import create_artist, create_song, create_user
 
 
@@ -157,3 +167,388 @@ class SongModelTests(TestCase):
         song.published = False
         song.save()
         self.assertEqual(song.pub_date, None)
+
+    def test_chords_analysis_on_save(self):
+        """
+        Saving a song should detect its key and its easiest semitone change.
+        """
+        song = create_song()
+        song.content = 'F     Bb\nla la\nC     F\nla la'
+        song.save()
+        self.assertEqual(song.key, 'F')
+        self.assertEqual(song.best_shift, 2)
+        self.assertEqual(song.barre_chords, 0)
+        self.assertEqual(song.tojson()['key'], 'F')
+
+
+class MinHashBandModelTests(TestCase):
+    def setUp(self):
+        content = '\n'.join('Am C G\nline{0} of the lyrics'.format(i)
+                             for i in range(15))
+        self.song = create_song(title='Original')
+        self.song.content = content
+        self.song.save()
+        self.copy = create_song(title='Copy', published=False)
+        self.copy.content = content.replace('line7', 'changed')
+        self.copy.save()
+        self.other = create_song(title='Other')
+        self.other.content = 'a completely different song about nothing'
+        self.other.save()
+
+    def test_index_follows_content(self):
+        """
+        The LSH buckets of a song must be replaced when its content changes.
+        """
+        bands = set(self.other.minhash_bands.values_list('band', flat=True))
+        self.assertEqual(len(bands), 16)
+        self.other.content = 'yet another song'
+        self.other.save()
+        self.assertFalse(bands & set(
+            self.other.minhash_bands.values_list('band', flat=True)))
+
+    def test_probable_duplicates(self):
+        """
+        A near-duplicate is found even for an unsaved song, while unrelated
+        songs and the song itself are not.
+        """
+        self.assertEqual(self.song.probable_duplicates(), [self.copy])
+        self.assertEqual(self.song.probable_duplicates(
+            Song.objects.filter(published=True)), [])
+        submitted = Song(title='Resubmitted', content=self.song.content)
+        duplicates = submitted.probable_duplicates()
+        self.assertEqual(duplicates[0], self.song)
+        self.assertEqual(duplicates[0].similarity, 1.0)
+        self.assertEqual(self.other.probable_duplicates(), [])
+
+    def test_duplicate_pairs(self):
+        """
+        The admin report lists each pair of near-duplicates once.
+        """
+        pairs = MinHashBand.duplicate_pairs()
+        self.assertEqual(len(pairs), 1)
+        similarity, song, copy = pairs[0]
+        self.assertEqual((song, copy), (self.song, self.copy))
+        self.assertGreater(similarity, 0.5)
+
+
+class LyricsWordModelTests(TestCase):
+    def test_lyrics_index_follows_content(self):
+        """
+        The lyrics index must be updated every time the content of a song
+        changes.
+        """
+        song = create_song()
+        song.content = 'C\nlala lala mama'
+        song.save()
+        self.assertEqual(
+            sorted(song.lyrics_words.values_list('word', 'count')),
+            [('lala', 2), ('mama', 1)])
+
+        song = Song.objects.get(id=song.id)
+        song.content = 'papa'
+        song.save()
+        self.assertEqual(list(song.lyrics_words.values_list('word', flat=True)),
+                         ['papa'])
+
+    def test_search_ranks_by_matched_words(self):
+        """
+        Songs matching more words of the query should come first and
+        unpublished songs should not be returned.
+        """
+        song1 = create_song(title='Song1')
+        song1.content = 'the wind of change'
+        song1.save()
+        song2 = create_song(title='Song2')
+        song2.content = 'blowing in the wind'
+        song2.save()
+        song3 = create_song(title='Song3', published=False)
+        song3.content = 'wind of change'
+        song3.save()
+
+        self.assertEqual(LyricsWord.search('wind of change'),
+                         [song1.id, song2.id])
+        self.assertEqual(LyricsWord.search('Ξ'), [])
+
+
+class SongQuerySetTests(TestCase):
+    def test_publish_publishes_only_unpublished_songs(self):
+        """
+        Publishing a queryset should publish every unpublished song in it and
+        leave the already published ones untouched.
+        """
+        song_pub = create_song(title='Published', published=True)
+        song_unpub = create_song(title='Unpublished', published=False)
+        pub_date = song_pub.pub_date
+
+        song_ids = Song.objects.all().publish()
+        self.assertEqual(song_ids, [song_unpub.id])
+
+        song_pub.refresh_from_db()
+        song_unpub.refresh_from_db()
+        self.assertEqual(song_pub.pub_date, pub_date)
+        self.assertTrue(song_unpub.published)
+        self.assertLessEqual(song_unpub.pub_date, timezone.now())
+
+    def test_unpublish_unpublishes_published_songs(self):
+        """
+        Unpublishing a queryset should unpublish every song in it and clear
+        their publish date.
+        """
+        create_song(published=True)
+        create_song(published=True)
+
+        song_ids = Song.objects.all().unpublish()
+        self.assertEqual(len(song_ids), 2)
+        self.assertFalse(Song.objects.filter(published=True).exists())
+        self.assertFalse(Song.objects.filter(pub_date__isnull=False).exists())
+
+    def test_signals_receive_the_batch_of_ids(self):
+        """
+        Receivers should be notified once per batch with the affected ids.
+        """
+        songs = [create_song(published=False) for i in range(3)]
+        batches = []
+        def receiver(sender, song_ids, **kwargs):
+            batches.append(sorted(song_ids))
+        songs_published.connect(receiver)
+        songs_unpublished.connect(receiver)
+
+        try:
+            Song.objects.all().publish()
+            Song.objects.all().unpublish()
+        finally:
+            songs_published.disconnect(receiver)
+            songs_unpublished.disconnect(receiver)
+
+        song_ids = sorted(song.id for song in songs)
+        self.assertEqual(batches, [song_ids, song_ids])
+
+
+class SongViewModelTests(TestCase):
+    def test_record_once_per_day(self):
+        """
+        A user's views of a song are logged and counted once per day.
+        """
+        song = create_song()
+        user = create_user()
+        self.assertTrue(SongView.record(song.id, user))
+        self.assertFalse(SongView.record(song.id, user))
+        SongView.objects.update(day=timezone.now().date() - datetime.timedelta(days=1))
+        self.assertTrue(SongView.record(song.id, user))
+        self.assertEqual(Song.objects.get(id=song.id).view_count, 2)
+
+    def test_prune_keeps_view_count(self):
+        """
+        Pruning drops the days older than the retention period, but not the
+        views they added to the song totals.
+        """
+        song = create_song()
+        SongView.record(song.id, create_user())
+        SongView.objects.update(day=timezone.now().date() - datetime.timedelta(days=10))
+        call_command('prune', 'song_views', days=30, stdout=StringIO())
+        self.assertEqual(SongView.objects.count(), 1)
+        call_command('prune', 'song_views', days=5, stdout=StringIO())
+        self.assertFalse(SongView.objects.exists())
+        self.assertEqual(Song.objects.get(id=song.id).view_count, 1)
+
+    def test_migrate_song_views(self):
+        """
+        The old viewedBy rows must be moved to the log and the view counts.
+        """
+        song = create_song()
+        users = [create_user(username='user{0}'.format(i)) for i in range(3)]
+        SongView.record(song.id, users[0])
+        song.viewedBy.add(*users)
+        call_command('migrate_song_views', batch_size=2, stdout=StringIO())
+        self.assertFalse(song.viewedBy.exists())
+        self.assertEqual(SongView.objects.filter(song=song).count(), 3)
+        self.assertEqual(Song.objects.get(id=song.id).view_count, 4)
+
+
+class RelatedSongTests(TestCase):
+    def setUp(self):
+        self.users = [create_user(username='user{0}'.format(i)) for i in range(3)]
+        self.songs = [create_song(title='song{0}'.format(i), published=True)
+                      for i in range(4)]
+        a, b, c, d = self.songs
+        u0, u1, u2 = self.users
+        for song, user in [(a, u0), (a, u1), (b, u0), (b, u1), (c, u1)]:
+            SongView.record(song.id, user)
+        c.bookmarkedBy.add(u2)
+        d.bookmarkedBy.add(u2)
+
+    def test_build_related_songs(self):
+        """
+        Songs are related to the songs that share users with them, the ones
+        that share more users coming first.
+        """
+        call_command('build_related_songs', stdout=StringIO())
+        a, b, c, d = self.songs
+        self.assertEqual(list(a.related_songs()), [b, c])
+        self.assertEqual(list(d.related_songs()), [c])
+        self.assertEqual(list(c.related_songs(limit=1)), [d])
+
+    def test_build_related_songs_replaces_previous(self):
+        """
+        Rebuilding drops the stale related songs and respects --top.
+        """
+        call_command('build_related_songs', stdout=StringIO())
+        self.songs[3].bookmarkedBy.clear()
+        call_command('build_related_songs', top=1, stdout=StringIO())
+        self.assertFalse(RelatedSong.objects.filter(related=self.songs[3]).exists())
+        self.assertEqual(RelatedSong.objects.filter(song=self.songs[0]).count(), 1)
+
+    def test_related_songs_unpublished(self):
+        """
+        Unpublished songs are never shown as related.
+        """
+        call_command('build_related_songs', stdout=StringIO())
+        self.songs[1].unpublish()
+        self.assertEqual(list(self.songs[0].related_songs()), [self.songs[2]])
+
+    def test_top_similar_python(self):
+        """
+        The pure Python fallback finds the same scores as the SciPy one.
+        """
+        vectors = build_related_songs.song_vectors()
+        similar = build_related_songs.top_similar_python(vectors, 10)
+        if build_related_songs.scipy is not None:
+            expected = build_related_songs.top_similar_scipy(vectors, 10)
+            self.assertEqual(similar.keys(), expected.keys())
+            for song_id, scores in similar.items():
+                self.assertEqual([s for _, s in scores],
+                                 [s for _, s in expected[song_id]])
+                for (score, _), (expected_score, _) in zip(scores, expected[song_id]):
+                    self.assertAlmostEqual(score, expected_score)
+        a, b, c, d = self.songs
+        self.assertAlmostEqual(similar[a.id][0][0], 1.0)
+        self.assertEqual([s for _, s in similar[d.id]], [c.id])
+
+
+@override_settings(CACHES=settings.LOCMEM_CACHE)
+class SongCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        MyCache.HOT_SONGS.clear()
+        self.song = create_song(title='Song')
+
+    def test_hits_skip_the_database(self):
+        """
+        Cached songs must be served from the process memory, or from the
+        shared cache when another process loaded them.
+        """
+        MyCache.song(self.song.slug)
+        with self.assertNumQueries(0):
+            self.assertEqual(MyCache.song(self.song.slug), self.song)
+        MyCache.HOT_SONGS.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(MyCache.song(self.song.slug).title, 'Song')
+        self.assertIsNone(MyCache.song('missing'))
+
+    def test_changes_bump_the_version(self):
+        """
+        Saving, publishing or unpublishing a song, or renaming its artist,
+        must stop every process from serving its old copy.
+        """
+        MyCache.song(self.song.slug)
+        self.song.title = 'Renamed'
+        self.song.save()
+        self.assertEqual(MyCache.song(self.song.slug).title, 'Renamed')
+
+        Song.objects.filter(id=self.song.id).unpublish()
+        self.assertFalse(MyCache.song(self.song.slug).published)
+
+        artist = create_artist(name='Artist')
+        Song.objects.filter(id=self.song.id).update(artist=artist)
+        MyCache.bump_song_versions([self.song.slug])
+        MyCache.song(self.song.slug)
+        artist.name = 'Renamed artist'
+        artist.save()
+        self.assertEqual(MyCache.song(self.song.slug).artist.name, 'Renamed artist')
+
+        self.song.delete()
+        self.assertIsNone(MyCache.song(self.song.slug))
+
+
+@override_settings(CACHES=settings.LOCMEM_CACHE)
+class CacheNamespaceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_generation(self):
+        """
+        Bumping a namespace must change the keys of that namespace only.
+        """
+        MyCache.bump_generation('missing')
+        key = MyCache.namespaced('key', 'first', 'second')
+        self.assertEqual(MyCache.namespaced('key', 'first', 'second'), key)
+        MyCache.bump_generation('third')
+        self.assertEqual(MyCache.namespaced('key', 'first', 'second'), key)
+        MyCache.bump_generation('second')
+        self.assertNotEqual(MyCache.namespaced('key', 'first', 'second'), key)
+
+    @override_settings(CACHES=settings.DUMMY_CACHE)
+    def test_generation_without_a_cache(self):
+        """
+        When the cache keeps nothing, a generation must still only change
+        when it is bumped.
+        """
+        generation = MyCache.generation('namespace')
+        self.assertEqual(MyCache.generation('namespace'), generation)
+        MyCache.bump_generation('namespace')
+        self.assertNotEqual(MyCache.generation('namespace'), generation)
+
+    def test_artist_songs(self):
+        """
+        The cached songs of an artist must follow the publishing of songs and
+        songs moving to another artist.
+        """
+        artist = create_artist(name='Artist')
+        other = create_artist(name='Other')
+        song = create_song(title='Song', artist=artist)
+        self.assertEqual(MyCache.artist_songs(artist),
+                         [{'slug' : song.slug, 'title' : 'Song'}])
+        Song.objects.filter(id=song.id).unpublish()
+        self.assertEqual(MyCache.artist_songs(artist), [])
+        song = Song.objects.get(id=song.id)
+        song.publish()
+        self.assertEqual(MyCache.artist_songs(other), [])
+        song.artist = other
+        song.save()
+        self.assertEqual(MyCache.artist_songs(artist), [])
+        self.assertEqual(MyCache.artist_songs(other),
+                         [{'slug' : song.slug, 'title' : 'Song'}])
+
+    def test_user_deletion_drops_user_keys(self):
+        """
+        Deleting a user must invalidate all the cache entries of the user.
+        """
+        user = create_user()
+        MyCache.add_recently_viewed(user, 1)
+        key = MyCache.user_key(MyCache.Keys.RECENTLY_VIEWED, user)
+        user_id = user.id
+        user.delete()
+        user.id = user_id
+        self.assertNotEqual(MyCache.user_key(MyCache.Keys.RECENTLY_VIEWED, user), key)
+        self.assertEqual(MyCache.recently_viewed_song_ids(user), [])
+
+
+@override_settings(CACHES=settings.LOCMEM_CACHE)
+class WarmCachesTests(TestCase):
+    def test_warm_caches(self):
+        """
+        After warming up, the lists, the counts and the hottest songs must be
+        served without touching the database, and every template must load.
+        """
+        cache.clear()
+        MyCache.HOT_SONGS.clear()
+        song = create_song(title='Hot')
+        create_song(title='Cold', published=False)
+        out = StringIO()
+        call_command('warm_caches', songs=5, stdout=out)
+        self.assertIn('Warmed 1 songs', out.getvalue())
+        with self.assertNumQueries(0):
+            self.assertEqual(MyCache.song(song.slug), song)
+            self.assertEqual(list(MyCache.recent_songs()[:7]), [song])
+            self.assertEqual(MyCache.published_songs_count(), 1)
+            self.assertEqual(MyCache.users_count(), 0)
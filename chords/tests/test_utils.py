@@ -20,3 +20,121 @@ class TestUtils(SimpleTestCase):
         """
         s = 'lorem ipsum\nlorem ipsum'
         self.assertEqual(utils.strip_whitespace_lines(s), s)
+
+    def test_sorted_id_set_membership(self):
+        """
+        SortedIdSet should keep its ids sorted and unique, and report
+        membership correctly.
+        """
+        ids = utils.SortedIdSet([5, 1, 3, 3])
+        self.assertEqual(list(ids), [1, 3, 5])
+        self.assertIn(3, ids)
+        self.assertNotIn(4, ids)
+        self.assertNotIn(0, utils.SortedIdSet())
+
+    def test_greeklish_normalize_maps_spelling_variations(self):
+        """
+        Greek text and the common ways of spelling it in greeklish should all
+        be normalized to the same string.
+        """
+        for s in ['Αγάπη', 'agapi', 'aghapi', 'AGAPH']:
+            self.assertEqual(utils.greeklish_normalize(s), 'agapi')
+        for s in ['Ουρανός', 'ouranos', 'oyranos']:
+            self.assertEqual(utils.greeklish_normalize(s), 'uranos')
+
+    def test_trigrams(self):
+        """
+        The trigrams() function should return the padded trigrams of every
+        word of the string.
+        """
+        self.assertEqual(utils.trigrams('ab Cd'),
+                         {'  a', ' ab', 'ab ', '  c', ' cd', 'cd '})
+        self.assertEqual(utils.trigrams(''), set())
+
+    def test_lyrics_words_skip_chord_and_tab_lines(self):
+        """
+        The lyrics_words() function should return the normalized words of the
+        lyrics, without chords or tabs.
+        """
+        content = ('Am   C/G  F (x2)\n'
+                   'Στο δρόμο, a Song\n'
+                   'e|---0---1---3---|\n'
+                   'G       D\n'
+                   'Ένα τραγούδι')
+        self.assertEqual(utils.lyrics_words(content),
+                         ['sto', 'dromo', 'song', 'ena', 'tragudi'])
+
+    def test_extract_chords(self):
+        """
+        The extract_chords() function should return the chords of the chord
+        lines only, with flats converted to sharps.
+        """
+        content = ('Am   Bb/G  F7 (x2)\n'
+                   'A Song about Em\n'
+                   'e|---0---1---3---|\n'
+                   'Gsus4       Db')
+        self.assertEqual(utils.extract_chords(content),
+                         ['Am', 'A#', 'G', 'F7', 'Gsus4', 'C#'])
+
+    def test_chords_mask(self):
+        """
+        The chords_mask() function should set one bit per known chord and the
+        unknown chord bit for chords without a diagram.
+        """
+        self.assertEqual(len(utils.CHORD_VOCABULARY), 240)
+        self.assertEqual(utils.chords_mask([]), 0)
+        self.assertEqual(utils.chords_mask(['C', 'C']), 1)
+        self.assertEqual(utils.chords_mask(['Cadd9']),
+                         1 << utils.UNKNOWN_CHORD_BIT)
+
+    def test_detect_key(self):
+        """
+        The detect_key() function should find the key of common progressions
+        and tell major keys from their relative minor ones.
+        """
+        self.assertEqual(utils.detect_key(['G', 'C', 'D', 'Em', 'G']), 'G')
+        self.assertEqual(utils.detect_key(['Am', 'Dm', 'E7', 'Am']), 'Am')
+        self.assertEqual(utils.detect_key(['F#m', 'D', 'A', 'E', 'F#m']), 'F#m')
+        self.assertEqual(utils.detect_key([]), '')
+
+    def test_best_shift(self):
+        """
+        The best_shift() function should return the smallest semitone change
+        that needs the fewest barre chords.
+        """
+        self.assertEqual(utils.best_shift(['G', 'C', 'D']), (0, 0))
+        self.assertEqual(utils.best_shift(['F', 'A#', 'C']), (2, 0))
+        self.assertEqual(utils.best_shift(['F#m', 'D', 'A', 'E']), (-2, 0))
+        self.assertEqual(utils.best_shift([]), (0, 0))
+
+    def test_minhash_similarity(self):
+        """
+        The MinHash signatures of near-duplicate songs should agree on most
+        rows, unlike the ones of unrelated songs.
+        """
+        content = ' '.join('word{0}'.format(i) for i in range(60))
+        changed = content.replace('word30', 'other')
+        unrelated = ' '.join('song{0}'.format(i) for i in range(60))
+        signature = utils.minhash_signature(content)
+        self.assertEqual(len(utils.minhash_bands(signature)), utils.MINHASH_BANDS)
+        self.assertEqual(utils.minhash_similarity(signature, signature), 1.0)
+        self.assertGreater(utils.minhash_similarity(
+            signature, utils.minhash_signature(changed)), 0.8)
+        self.assertLess(utils.minhash_similarity(
+            signature, utils.minhash_signature(unrelated)), 0.2)
+        self.assertEqual(utils.minhash_signature(''), '')
+        self.assertEqual(utils.minhash_bands(''), [])
+
+    def test_lru_cache(self):
+        """
+        The LRUCache should evict the least recently used key when full.
+        """
+        lru = utils.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual((lru.get('a'), lru.get('c'), len(lru)), (1, 3, 2))
+        lru.delete('a')
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
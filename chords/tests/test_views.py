@@ -1,15 +1,29 @@
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, TransactionTestCase, RequestFactory, Client
 from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.http.response import Http404
 from django.conf import settings
-
-import os
-
-from chords.models import Song
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock
+
+from chords.models import (Song, User, Comment, SongView, SongViewBucket,
+                           SongDraft, MyCache)
 from chords.forms import SearchForm
-from chords.views import user as user_view, song as song_view
+from chords.admin import EstimatedCountPaginator
+from chords.views import (user as user_view, song as song_view, page_cache,
+                          tag_page, SEARCH_RESULTS_PER_PAGE, SONG_DRAFT_SESSION_KEY,
+                          CAPTCHA_PASSED_SESSION_KEY)
 from .helper_functions import (create_artist, create_song, create_user,
                                valid_song_data, valid_contact_data)
 
@@ -23,6 +37,15 @@ class LoginedTestCase(TestCase):
         self.user = create_user(password='password')
         self.client.login(username=self.user.username, password='password')
 
+    def store_song_draft(self, song_data):
+        draft = SongDraft(user=self.user)
+        draft.set_data(dict(song_data, user_txt=self.user.username))
+        draft.save()
+        session = self.client.session
+        session[SONG_DRAFT_SESSION_KEY] = draft.id
+        session.save()
+        return draft
+
 
 class IndexViewTests(TestCase):
     @override_settings(CACHES=settings.DUMMY_CACHE)
@@ -43,7 +66,8 @@ class IndexViewTests(TestCase):
         create_song(title='Random Song', published=True)
         response = self.client.get(reverse('chords:index'))
         self.assertQuerysetEqual(response.context['recent_songs'],
-                                 ['<Song: Random Song>'])
+                                 ['random-song'],
+                                 transform=lambda row: row['slug'])
 
     @override_settings(CACHES=settings.DUMMY_CACHE)
     def test_index_view_with_an_unpublished_song(self):
@@ -64,7 +88,8 @@ class IndexViewTests(TestCase):
         create_song(title='Another Random Song', published=False)
         response = self.client.get(reverse('chords:index'))
         self.assertQuerysetEqual(response.context['recent_songs'],
-                                 ['<Song: Random Song>'])
+                                 ['random-song'],
+                                 transform=lambda row: row['slug'])
 
     def test_count_numbers_are_up_to_date(self):
         """
@@ -100,29 +125,85 @@ class IndexViewTests(TestCase):
         """
         song1 = create_song(title='Song1', published=True)
         song2 = create_song(title='Song2', published=True)
-        song1.viewedBy.add(create_user(username='user1'))
+        SongView.record(song1.id, create_user(username='user1'))
 
         response = self.client.get(reverse('chords:index'))
         self.assertQuerysetEqual(response.context['popular_songs'],
-                                 ['<Song: Song1>', '<Song: Song2>'])
+                                 ['song1', 'song2'],
+                                 transform=lambda row: row['slug'])
 
-        song2.viewedBy.add(create_user(username='user2'))
-        song2.viewedBy.add(create_user(username='user3'))
+        SongView.record(song2.id, create_user(username='user2'))
+        SongView.record(song2.id, create_user(username='user3'))
 
         response = self.client.get(reverse('chords:index'))
         self.assertQuerysetEqual(response.context['popular_songs'],
-                                 ['<Song: Song2>', '<Song: Song1>'])
+                                 ['song2', 'song1'],
+                                 transform=lambda row: row['slug'])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_index_view_served_from_snapshot(self):
+        """
+        Once the homepage snapshot is cached, the index context should come
+        from a single cache read without touching the database.
+        """
+        cache.clear()
+        create_song(title='Random Song', published=True)
+        self.client.get(reverse('chords:index'))
+        with self.assertNumQueries(0):
+            context = MyCache.homepage()
+        self.assertEqual(context['song_count'], 1)
+        self.assertEqual(context['recent_songs'],
+                         [{'slug' : 'random-song',
+                           'full_title' : 'None - Random Song'}])
 
-    def test_index_view_erase_song_data(self):
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_index_view_snapshot_rebuilt_on_publish(self):
         """
-        Index view must remove song_data from the session.
+        Publishing or unpublishing a song should refresh the snapshot.
         """
+        cache.clear()
+        song = create_song(title='Random Song', published=False)
+        response = self.client.get(reverse('chords:index'))
+        self.assertEqual(response.context['recent_songs'], [])
+
+        song.publish()
+        song.save()
+        response = self.client.get(reverse('chords:index'))
+        self.assertQuerysetEqual(response.context['recent_songs'],
+                                 ['random-song'],
+                                 transform=lambda row: row['slug'])
+        self.assertEqual(response.context['song_count'], 1)
+
+        song.unpublish()
+        song.save()
+        response = self.client.get(reverse('chords:index'))
+        self.assertEqual(response.context['recent_songs'], [])
+        self.assertEqual(response.context['song_count'], 0)
+
+    def test_index_view_erase_song_draft(self):
+        """
+        Index view must discard the song draft of the session.
+        """
+        user = create_user()
+        self.client.login(username=user.username, password='password')
+        draft = SongDraft(user=user, data='{}')
+        draft.save()
         session = self.client.session
-        session['song_data'] = valid_song_data()
+        session[SONG_DRAFT_SESSION_KEY] = draft.id
         session.save()
-        self.assertTrue('song_data' in self.client.session)
         self.client.get(reverse('chords:index'))
-        self.assertFalse('song_data' in self.client.session)
+        self.assertFalse(SONG_DRAFT_SESSION_KEY in self.client.session)
+        self.assertFalse(SongDraft.objects.exists())
+
+    def test_index_view_does_not_write_the_session(self):
+        """
+        Without a song draft the index view must not save the session.
+        """
+        user = create_user()
+        self.client.login(username=user.username, password='password')
+        with mock.patch(settings.SESSION_ENGINE + '.SessionStore.save') as save:
+            self.client.get(reverse('chords:index'))
+        self.assertFalse(save.called)
 
 
 class ArtistViewTests(TestCase):
@@ -160,8 +241,8 @@ class ArtistViewTests(TestCase):
         song = create_song(published=True, artist=create_artist())
         response = self.client.get(reverse('chords:artist',
                                    args=(song.artist.slug,)))
-        self.assertQuerysetEqual(response.context['songs'],
-                                 ['<Song: Random Song>'])
+        self.assertEqual(response.context['songs'],
+                         [{'slug' : 'random-song', 'title' : 'Random Song'}])
 
     def test_artist_view_with_an_unpublished_song(self):
         """
@@ -182,8 +263,8 @@ class ArtistViewTests(TestCase):
         create_song(artist=artist, published=False)
 
         response = self.client.get(reverse('chords:artist', args=(artist.slug,)))
-        self.assertQuerysetEqual(response.context['songs'],
-                                 ['<Song: Random Song>'])
+        self.assertEqual(response.context['songs'],
+                         [{'slug' : 'random-song', 'title' : 'Random Song'}])
 
 
 class UserViewTests(TestCase):
@@ -394,6 +475,53 @@ class AddSongViewTests(LoginedTestCase):
         response = self.client.post(reverse('chords:add_song'), valid_song_data())
         self.assertEqual(response.status_code, 302)
 
+    def test_addsong_view_stores_a_song_draft(self):
+        """
+        The submitted song must be kept in a draft referenced by the session,
+        which is updated when the form is submitted again.
+        """
+        self.client.post(reverse('chords:add_song'), valid_song_data())
+        draft = SongDraft.objects.get(user=self.user)
+        self.assertEqual(self.client.session[SONG_DRAFT_SESSION_KEY], draft.id)
+        self.assertEqual(draft.get_data()['user_txt'], self.user.username)
+
+        self.client.post(reverse('chords:add_song'),
+                         valid_song_data(title='Another title'))
+        draft = SongDraft.objects.get(user=self.user)
+        self.assertEqual(draft.get_data()['title'], 'Another title')
+
+        response = self.client.get(reverse('chords:add_song'))
+        self.assertEqual(response.context['form'].initial['title'],
+                         'Another title')
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE,
+                       SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+    def test_song_draft_with_cached_db_sessions(self):
+        """
+        The add song flow must work with sessions kept in the cache.
+        """
+        cache.clear()
+        self.client.post(reverse('chords:add_song'),
+                         valid_song_data(title='Draft title'))
+        self.assertContains(self.client.get(reverse('chords:verify_song')),
+                            'Draft title')
+        self.client.get(reverse('chords:song_submitted'))
+        self.assertFalse(SongDraft.objects.exists())
+
+    def test_expired_song_draft_is_ignored(self):
+        """
+        Once a song draft has expired verify_song must start over.
+        """
+        draft = self.store_song_draft(valid_song_data())
+        SongDraft.objects.filter(id=draft.id).update(
+                mod_date=timezone.now() - SongDraft.TTL * 2)
+        response = self.client.get(reverse('chords:verify_song'))
+        self.assertRedirects(response, reverse('chords:add_song'))
+        out = StringIO()
+        call_command('prune', stdout=out)
+        self.assertIn('Deleted 1 song drafts.', out.getvalue())
+        self.assertFalse(SongDraft.objects.exists())
+
     def test_addsong_view_with_invalid_input(self):
         """
         The add_song view must return an appropriate message for each case of
@@ -422,21 +550,29 @@ class AddSongViewTests(LoginedTestCase):
         self.assertContains(response, 'Enter a valid URL.')
 
 
+def solve_captcha(valid=True):
+    """
+    Patch the reCAPTCHA client so that every answer is checked as valid, or
+    invalid, without asking Google.
+    """
+    return mock.patch('captcha.client.submit',
+                      return_value=mock.Mock(is_valid=valid))
+
+
 class AddCommentViewTests(LoginedTestCase):
     def test_with_valid_data(self):
         """
         After posting to the add_comment view with valid data, one more comment
         should be assigned to the corresponding user and song.
         """
-        os.environ['RECAPTCHA_TESTING'] = 'True'
-
         song = create_song()
         user_comments = self.user.comments.count()
         song_comments = song.comments.count()
 
         data = {'user' : self.user.id, 'song' : song.id,
-                'content' : 'comment', 'testing' : 'True'}
-        response = self.client.post(reverse('chords:add_comment'), data)
+                'content' : 'comment', 'g-recaptcha-response' : 'answer'}
+        with solve_captcha():
+            response = self.client.post(reverse('chords:add_comment'), data)
         self.assertEqual(response.status_code, 200)
 
         self.assertEqual(self.user.comments.count(), user_comments + 1)
@@ -447,33 +583,64 @@ class AddCommentViewTests(LoginedTestCase):
         Add_comment view should return responses with appropriate status codes
         when we submit invalid data to it.
         """
-        os.environ['RECAPTCHA_TESTING'] = 'True'
-
         song = create_song()
         user_comments = self.user.comments.count()
         song_comments = song.comments.count()
 
-        # user doesn't exist
-        data = {'user' : 'u', 'song' : song.id, 'content' : 'comment',
+        # captcha is wrong
+        data = {'user' : self.user.id, 'song' : song.id, 'content' : 'comment',
+                'g-recaptcha-response' : 'answer'}
+        with solve_captcha(valid=False):
+            response = self.client.post(reverse('chords:add_comment'), data)
+        self.assertEqual(response.status_code, 400)
+
+        # the old testing flag must not skip the captcha
+        data = {'user' : self.user.id, 'song' : song.id, 'content' : 'comment',
                 'testing' : 'True'}
         response = self.client.post(reverse('chords:add_comment'), data)
         self.assertEqual(response.status_code, 400)
 
+        session = self.client.session
+        session[CAPTCHA_PASSED_SESSION_KEY] = True
+        session.save()
+
+        # user doesn't exist
+        data = {'user' : 'u', 'song' : song.id, 'content' : 'comment'}
+        response = self.client.post(reverse('chords:add_comment'), data)
+        self.assertEqual(response.status_code, 400)
+
         # song doesn't exist
-        data = {'user' : self.user.id, 'song' : 'slug', 'content' : 'comment',
-                'testing' : 'True'}
+        data = {'user' : self.user.id, 'song' : 'slug', 'content' : 'comment'}
         response = self.client.post(reverse('chords:add_comment'), data)
         self.assertEqual(response.status_code, 400)
 
         # comment is missing
-        data = {'user' : self.user.id, 'song' : song.slug, 'comment' : '',
-                'testing' : 'True'}
+        data = {'user' : self.user.id, 'song' : song.slug, 'comment' : ''}
         response = self.client.post(reverse('chords:add_comment'), data)
         self.assertEqual(response.status_code, 400)
 
         self.assertEqual(self.user.comments.count(), user_comments)
         self.assertEqual(song.comments.count(), song_comments)
 
+    def test_captcha_asked_once_per_session(self):
+        """
+        Once the captcha has been solved, the next comments of the session
+        should not need one.
+        """
+        song = create_song()
+        data = {'user' : self.user.id, 'song' : song.id, 'content' : 'comment'}
+        response = self.client.post(reverse('chords:add_comment'), data)
+        self.assertEqual(response.status_code, 400)
+
+        with solve_captcha():
+            response = self.client.post(reverse('chords:add_comment'),
+                    dict(data, **{'g-recaptcha-response' : 'answer'}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('chords:add_comment'), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(song.comments.count(), 2)
+
 
 class VerifySongViewTests(LoginedTestCase):
     def test_verifysong_view_redirects_when_not_logged_in(self):
@@ -492,7 +659,7 @@ class VerifySongViewTests(LoginedTestCase):
         redirect to the add_song view.
         """
         response = self.client.get(reverse('chords:verify_song'))
-        self.assertFalse('song_data' in self.client.session)
+        self.assertFalse(SONG_DRAFT_SESSION_KEY in self.client.session)
         self.assertRedirects(response, reverse('chords:add_song'))
 
     def test_verifysong_view_with_song_data(self):
@@ -500,11 +667,24 @@ class VerifySongViewTests(LoginedTestCase):
         When there are valid song_data stored on the session the verify_song
         view must display the song.
         """
-        session = self.client.session
-        session['song_data'] = valid_song_data()
-        session.save()
+        self.store_song_draft(valid_song_data(title='Draft title'))
         response = self.client.get(reverse('chords:verify_song'))
-        self.assertContains(response, session['song_data']['title'])
+        self.assertContains(response, 'Draft title')
+
+    def test_verifysong_view_with_duplicate(self):
+        """
+        When the song looks like a published song, the verify_song view must
+        link to it.
+        """
+        content = '\n'.join('Am C G\nline{0} of the lyrics'.format(i)
+                             for i in range(15))
+        song = create_song(title='Already there')
+        song.content = content
+        song.save()
+        self.store_song_draft(valid_song_data(content=content))
+        response = self.client.get(reverse('chords:verify_song'))
+        self.assertEqual(response.context['duplicates'], [song])
+        self.assertContains(response, song.get_absolute_url())
 
 
 class SongSubmittedViewTests(LoginedTestCase):
@@ -524,7 +704,7 @@ class SongSubmittedViewTests(LoginedTestCase):
         must redirect to the add_song view.
         """
         response = self.client.get(reverse('chords:song_submitted'))
-        self.assertFalse('song_data' in self.client.session)
+        self.assertFalse(SONG_DRAFT_SESSION_KEY in self.client.session)
         self.assertRedirects(response, reverse('chords:add_song'))
 
     def test_songsubmitted_view_with_song_data(self):
@@ -532,9 +712,7 @@ class SongSubmittedViewTests(LoginedTestCase):
         When there are valid song_data stored on the session, one more
         _unpublished_ song must be added to the database.
         """
-        session = self.client.session
-        session['song_data'] = valid_song_data()
-        session.save()
+        self.store_song_draft(valid_song_data())
         pub_songs = Song.objects.filter(published=True).count()
         unpub_songs = Song.objects.filter(published=False).count()
 
@@ -543,7 +721,8 @@ class SongSubmittedViewTests(LoginedTestCase):
         self.assertEqual(pub_songs, Song.objects.filter(published=True).count())
         self.assertEqual(unpub_songs + 1,
                 Song.objects.filter(published=False).count())
-        self.assertFalse('song_data' in self.client.session)
+        self.assertFalse(SONG_DRAFT_SESSION_KEY in self.client.session)
+        self.assertFalse(SongDraft.objects.exists())
 
 
 class BookmarksViewTests(LoginedTestCase):
@@ -596,6 +775,38 @@ class BookmarksViewTests(LoginedTestCase):
                                  ['<Song: Random Song>'])
 
 
+class RecentlyViewedViewTests(LoginedTestCase):
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_most_recent_first(self):
+        """
+        The recently viewed view must list the viewed songs most recent first,
+        each one once, and keep only the last RECENTLY_VIEWED_SIZE of them.
+        """
+        cache.clear()
+        songs = [create_song(title='Song{0}'.format(i)) for i in range(3)]
+        for song in [songs[0], songs[1], songs[0], songs[2]]:
+            self.client.get(reverse('chords:song', args=(song.slug,)))
+        response = self.client.get(reverse('chords:recently_viewed'))
+        self.assertEqual(response.context['songs'], [songs[2], songs[0], songs[1]])
+
+        cache.clear()
+        with mock.patch.object(MyCache, 'RECENTLY_VIEWED_SIZE', 2):
+            for song in songs[:2] + [create_song(title='Song3')]:
+                MyCache.add_recently_viewed(self.user, song.id)
+        response = self.client.get(reverse('chords:recently_viewed'))
+        self.assertEqual([song.title for song in response.context['songs']],
+                         ['Song3', 'Song1'])
+
+    def test_redirects_when_not_logged_in(self):
+        """
+        The recently viewed view requires a logged in user.
+        """
+        self.client.logout()
+        response = self.client.get(reverse('chords:recently_viewed'))
+        self.assertRedirects(response,
+            reverse('auth_login') + '?next=' + reverse('chords:recently_viewed'))
+
+
 class AddBookmarkViewTests(LoginedTestCase):
     def test_add_bookmark_view_with_an_invalid_slug(self):
         """
@@ -633,6 +844,131 @@ class RemoveBookmarkViewTests(LoginedTestCase):
         self.assertTrue(self.user.bookmarks.count(), num_bookmarks - 1)
 
 
+class BookmarkStateTests(LoginedTestCase):
+    def bookmarked(self, song):
+        response = self.client.get(
+            reverse('chords:song_user_state', args=(song.slug,)))
+        return json.loads(response.content.decode())['bookmarked']
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_bookmark_state_follows_add_and_remove(self):
+        """
+        The song user state view should report the bookmark state of the
+        song, as it gets changed through the add_bookmark and remove_bookmark
+        views.
+        """
+        cache.clear()
+        song = create_song(published=True)
+
+        self.assertFalse(self.bookmarked(song))
+
+        self.client.get(reverse('chords:add_bookmark', args=(song.slug,)))
+        self.assertTrue(self.bookmarked(song))
+        response = self.client.get(reverse('chords:bookmarks'))
+        self.assertIn(song.id, response.context['bookmarked_ids'])
+        self.assertTrue(self.user.bookmarks.filter(id=song.id).exists())
+
+        self.client.get(reverse('chords:remove_bookmark', args=(song.slug,)))
+        self.assertFalse(self.bookmarked(song))
+        response = self.client.get(reverse('chords:bookmarks'))
+        self.assertNotIn(song.id, response.context['bookmarked_ids'])
+        self.assertFalse(self.user.bookmarks.filter(id=song.id).exists())
+
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_bookmark_toggles_do_not_lose_updates(self):
+        """
+        A bookmark added by a concurrent request after the set got cached
+        must not be lost by the next toggle.
+        """
+        cache.clear()
+        song1 = create_song(title='Song1', published=True)
+        song2 = create_song(title='Song2', published=True)
+        MyCache.bookmarked_song_ids(self.user)
+        # written to the database while the cached set is still empty
+        self.user.bookmarks.add(song1)
+
+        self.client.get(reverse('chords:add_bookmark', args=(song2.slug,)))
+        self.assertEqual(list(MyCache.bookmarked_song_ids(self.user)),
+                         [song1.id, song2.id])
+
+class SongUserStateViewTests(LoginedTestCase):
+    def test_user_state(self):
+        """
+        The song user state view must return the user, a CSRF token and the
+        navbar menu of logged in users, and nothing for anonymous ones.
+        """
+        song = create_song()
+        url = reverse('chords:song_user_state', args=(song.slug,))
+        data = json.loads(self.client.get(url).content.decode())
+        self.assertEqual(data['user'], {'id' : self.user.id,
+                                        'username' : self.user.username})
+        self.assertTrue(data['csrf_token'])
+        self.assertIn(reverse('chords:bookmarks'), data['navbar'])
+
+        self.client.logout()
+        data = json.loads(self.client.get(url).content.decode())
+        self.assertEqual(data, {'user' : None})
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_song_page_shared_by_all_users(self):
+        """
+        The song page must be the same for anonymous and logged in users, so
+        that it is cached once, while still counting the views of the users.
+        """
+        cache.clear()
+        song = create_song()
+        url = reverse('chords:song', args=(song.slug,))
+        content = self.client.get(url).content
+        self.assertNotIn(self.user.username.encode(), content)
+        self.assertNotIn(b'csrfmiddlewaretoken" value="', content.replace(
+            b'csrfmiddlewaretoken" value=""', b''))
+
+        self.client.logout()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).content, content)
+
+        self.client.login(username=self.user.username, password='password')
+        self.client.get(url)
+        self.assertEqual(MyCache.recently_viewed_song_ids(self.user), [song.id])
+        self.assertEqual(SongViewBucket.objects.get(song=song).views, 3)
+
+
+class SyncBookmarksViewTests(LoginedTestCase):
+    def test_sync_bookmarks_view_rejects_get(self):
+        """
+        The sync_bookmarks view should only accept POST requests.
+        """
+        response = self.client.get(reverse('chords:sync_bookmarks'))
+        self.assertEqual(response.status_code, 405)
+
+    def test_sync_bookmarks_view_adds_and_removes(self):
+        """
+        The sync_bookmarks view should add and remove all the given songs
+        and ignore unknown slugs and other users' unpublished songs.
+        """
+        song1 = create_song(title='Song1', published=True)
+        song2 = create_song(title='Song2', published=True)
+        song3 = create_song(title='Song3', published=True)
+        song_unpub = create_song(title='Song4', published=False,
+                                 sender=create_user(username='other'))
+        self.user.bookmarks.add(song3)
+
+        response = self.client.post(reverse('chords:sync_bookmarks'), {
+            'add' : [song1.slug, song2.slug, song_unpub.slug, 'slug'],
+            'remove' : [song3.slug]})
+        self.assertEqual(response.status_code, 200)
+        self.assertQuerysetEqual(self.user.bookmarks.order_by('title'),
+                                 ['<Song: Song1>', '<Song: Song2>'])
+
+        version = json.loads(response.content.decode())['version']
+        response = self.client.post(reverse('chords:sync_bookmarks'), {
+            'remove' : [song2.slug]})
+        self.assertNotEqual(json.loads(response.content.decode())['version'],
+                            version)
+        self.assertQuerysetEqual(self.user.bookmarks.all(), ['<Song: Song1>'])
+
+
 class SearchViewTests(TestCase):
     def test_without_query(self):
         """
@@ -753,6 +1089,347 @@ class SearchViewTests(TestCase):
                 ['<Song: Song Chords>'])
 
 
+class AutocompleteViewTests(TestCase):
+    def get_names(self, query):
+        response = self.client.get(reverse('chords:autocomplete'), {'q' : query})
+        results = json.loads(response.content.decode())['results']
+        return [result['name'] for result in results]
+
+    def test_autocomplete_matches_word_prefixes(self):
+        """
+        The autocomplete view should suggest published songs, artists and
+        users having a word that starts with the query.
+        """
+        create_song(title='Random Song', published=True)
+        create_song(title='Random Unpublished Song', published=False)
+        create_artist(name='Random Artist')
+        create_user(username='randomuser')
+
+        self.assertEqual(sorted(self.get_names('rand')),
+                         ['Random Artist', 'Random Song', 'randomuser'])
+        self.assertEqual(self.get_names('son'), ['Random Song'])
+        self.assertEqual(self.get_names('xyz'), [])
+        self.assertEqual(self.get_names(''), [])
+
+    def test_autocomplete_with_greeklish_query(self):
+        """
+        Greek names should be suggested for both greek and greeklish queries.
+        """
+        create_song(title='Τυχαίο τραγούδι', published=True)
+        self.assertEqual(self.get_names('tyxaio'), ['Τυχαίο τραγούδι'])
+        self.assertEqual(self.get_names('τραγ'), ['Τυχαίο τραγούδι'])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_autocomplete_index_follows_publishing(self):
+        """
+        The index should pick up songs as soon as they get published and drop
+        them when they get unpublished.
+        """
+        cache.clear()
+        song = create_song(title='Random Song', published=False)
+        self.assertEqual(self.get_names('random'), [])
+        song.publish()
+        self.assertEqual(self.get_names('random'), ['Random Song'])
+        Song.objects.all().unpublish()
+        self.assertEqual(self.get_names('random'), [])
+
+
+class SearchCacheTests(TestCase):
+    def search(self, **kwargs):
+        params = {'searchBy' : SearchForm.SEARCH_SONG, 'keywords' : 'song'}
+        params.update(kwargs)
+        return self.client.get(reverse('chords:search'), params)
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_cached_results_follow_the_catalogue(self):
+        """
+        Equivalent searches should be answered from the cache, until a song
+        gets published or unpublished.
+        """
+        cache.clear()
+        song = create_song(title='Song', published=True)
+        self.assertQuerysetEqual(self.search().context['results'],
+                                 ['<Song: Song>'])
+
+        with self.assertNumQueries(1):
+            response = self.search(keywords=' SONG ')
+        self.assertQuerysetEqual(response.context['results'], ['<Song: Song>'])
+
+        song.unpublish()
+        self.assertQuerysetEqual(self.search().context['results'], [])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_song_unpublished_by_save_leaves_the_caches(self):
+        """
+        A song unpublished by saving it, as the admin does, should disappear
+        from the cached search results, autocomplete and song lists.
+        """
+        cache.clear()
+        song = create_song(title='Song', published=True)
+        song = Song.objects.get(id=song.id)
+        self.assertQuerysetEqual(self.search().context['results'],
+                                 ['<Song: Song>'])
+        self.client.get(reverse('chords:autocomplete'), {'q' : 'song'})
+        self.assertContains(self.client.get(reverse('chords:recently_added')),
+                            song.get_absolute_url())
+
+        song.published = False
+        song.save()
+        self.assertQuerysetEqual(self.search().context['results'], [])
+        response = self.client.get(reverse('chords:autocomplete'), {'q' : 'song'})
+        self.assertEqual(json.loads(response.content.decode())['results'], [])
+        self.assertNotContains(
+                self.client.get(reverse('chords:recently_added')),
+                song.get_absolute_url())
+        self.assertEqual(MyCache.published_songs_count(), 0)
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_catalogue_version_bumped_on_search_changes_only(self):
+        """
+        Saving a song without changing what is searched, or signing up a
+        user, should keep the catalogue indexes and search results.
+        """
+        cache.clear()
+        song = create_song(title='Song', published=True)
+        song = Song.objects.get(id=song.id)
+        version = MyCache.catalogue_version()
+        usernames = MyCache.usernames_version()
+
+        song.save()
+        create_user()
+        self.assertEqual(MyCache.catalogue_version(), version)
+        self.assertNotEqual(MyCache.usernames_version(), usernames)
+
+        song.title = 'Another Song'
+        song.save()
+        self.assertNotEqual(MyCache.catalogue_version(), version)
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_user_search_keywords_normalized_once(self):
+        """
+        A user search with surrounding spaces should find the same users as
+        the one without, and share its cached results.
+        """
+        cache.clear()
+        create_user(username='bobby')
+        for keywords in ['bob ', 'bob']:
+            response = self.search(searchBy=SearchForm.SEARCH_USER,
+                                   keywords=keywords)
+            self.assertQuerysetEqual(response.context['results'],
+                                     ['<User: bobby>'])
+
+    def test_results_over_the_limit(self):
+        """
+        When a search has more results than the limit, the page should say
+        so instead of reporting the limit as the number of results.
+        """
+        for i in range(3):
+            create_song(title='Song {0}'.format(i), published=True)
+
+        with mock.patch('chords.views.SEARCH_RESULTS_LIMIT', 2):
+            response = self.search()
+        self.assertTrue(response.context['truncated'])
+        self.assertEqual(len(response.context['results']), 2)
+        self.assertContains(response, 'We found 2+ relative results')
+
+        response = self.search()
+        self.assertFalse(response.context['truncated'])
+        self.assertContains(response, 'We found 3 relative results')
+
+    def test_results_are_paginated(self):
+        """
+        Results should be split in pages, which keep their order.
+        """
+        for i in range(SEARCH_RESULTS_PER_PAGE + 1):
+            create_song(title='Song {0:03}'.format(i), published=True)
+
+        response = self.search()
+        self.assertEqual(len(response.context['results']),
+                         SEARCH_RESULTS_PER_PAGE)
+        self.assertEqual(response.context['results'][0].title, 'Song 000')
+
+        response = self.search(page=2)
+        self.assertQuerysetEqual(response.context['results'],
+                ['<Song: Song {0:03}>'.format(SEARCH_RESULTS_PER_PAGE)])
+
+        response = self.search(page=2, orderBy='nameDesc')
+        self.assertQuerysetEqual(response.context['results'],
+                                 ['<Song: Song 000>'])
+
+    def test_page_links_keep_the_order(self):
+        """
+        The links to the other pages should keep the order of the results,
+        while the sorting requests of the results table get only its rows.
+        """
+        for i in range(SEARCH_RESULTS_PER_PAGE + 1):
+            create_song(title='Song {0:03}'.format(i), published=True)
+
+        response = self.search(orderBy='nameDesc')
+        self.assertTemplateUsed(response, 'chords/search.html')
+        self.assertContains(response, 'orderBy=nameDesc&amp;page=2')
+        self.assertContains(response, 'id="id_orderBy" value="nameDesc"')
+
+        response = self.search(page=2, orderBy='nameDesc')
+        self.assertContains(response, 'orderBy=nameDesc&amp;page=1')
+
+        response = self.client.get(reverse('chords:search'), {
+                'searchBy' : SearchForm.SEARCH_SONG, 'keywords' : 'song',
+                'orderBy' : 'nameDesc'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTemplateNotUsed(response, 'chords/search.html')
+        self.assertContains(response, 'Song {0:03}'.format(
+                SEARCH_RESULTS_PER_PAGE))
+
+
+class SearchFacetsTests(TestCase):
+    def test_search_song_shows_facet_counts(self):
+        """
+        The genre and tabs choices should show how many of the songs matching
+        the keywords they include, whatever the selected filters.
+        """
+        create_song(title='Song Rock', genre=Song.ROCK, published=True)
+        create_song(title='Song Rock Tabs', genre=Song.ROCK, tabs=True,
+                    published=True)
+        create_song(title='Song Blues', genre=Song.BLUES, published=True)
+        create_song(title='Other', genre=Song.BLUES, published=True)
+
+        response = self.client.get(reverse('chords:search'), {
+            'searchBy' : SearchForm.SEARCH_SONG, 'keywords' : 'song',
+            'genre' : Song.ROCK, 'tabs' : SearchForm.CHORDS_ONLY})
+        self.assertQuerysetEqual(response.context['results'],
+                                 ['<Song: Song Rock>'])
+
+        form = response.context['form']
+        genres = dict(form.fields['genre'].choices)
+        self.assertEqual(genres[SearchForm.GENRE_ALL], 'All (3)')
+        self.assertEqual(genres[Song.ROCK], 'Rock (2)')
+        self.assertEqual(genres[Song.BLUES], 'Blues (1)')
+        self.assertEqual(genres[Song.POP], 'Pop (0)')
+        tabs = dict(form.fields['tabs'].choices)
+        self.assertEqual(tabs[SearchForm.CHORDS_ONLY], 'Chords only (2)')
+
+
+class FuzzySearchViewTests(TestCase):
+    def search(self, searchBy, keywords):
+        return self.client.get(reverse('chords:search'), {
+            'searchBy' : searchBy, 'keywords' : keywords, 'fuzzy' : 'on'})
+
+    def test_fuzzy_search_tolerates_greeklish_variations_and_typos(self):
+        """
+        Fuzzy search should match greek titles given in greeklish with any
+        common spelling, or with a typo.
+        """
+        create_song(title='Αγάπη μου', published=True)
+        create_song(title='Κάτι άλλο', published=True)
+
+        for k in ['agapi mou', 'aghapi moy', 'αγαπη', 'agapu mou']:
+            response = self.search(SearchForm.SEARCH_SONG, k)
+            self.assertQuerysetEqual(response.context['results'],
+                                     ['<Song: Αγάπη μου>'])
+
+    def test_fuzzy_search_ranks_by_similarity(self):
+        """
+        The most similar songs should come first.
+        """
+        create_song(title='Random Song Again', published=True)
+        create_song(title='Random Song', published=True)
+        create_song(title='Random Unpublished Song', published=False)
+
+        response = self.search(SearchForm.SEARCH_SONG, 'random song')
+        self.assertQuerysetEqual(response.context['results'],
+                ['<Song: Random Song>', '<Song: Random Song Again>'])
+
+    def test_fuzzy_search_artist(self):
+        """
+        Fuzzy search should also work for artists.
+        """
+        create_artist(name='Βασίλης Παπακωνσταντίνου')
+        response = self.search(SearchForm.SEARCH_ARTIST, 'vasilis papakonstantinou')
+        self.assertQuerysetEqual(response.context['results'],
+                                 ['<Artist: Βασίλης Παπακωνσταντίνου>'])
+
+
+class LyricsSearchViewTests(TestCase):
+    def test_search_by_lyrics(self):
+        """
+        Searching by lyrics should find songs by a line of their lyrics,
+        given in greek or greeklish.
+        """
+        song = create_song(title='Random Song', published=True)
+        song.content = 'Am\nΜια φορά κι έναν καιρό'
+        song.save()
+        create_song(title='Another Song', published=True)
+
+        for k in ['μια φορά', 'mia fora', 'kairo']:
+            response = self.client.get(reverse('chords:search'), {
+                'searchBy' : SearchForm.SEARCH_LYRICS, 'keywords' : k})
+            self.assertQuerysetEqual(response.context['results'],
+                                     ['<Song: Random Song>'])
+
+
+class ChordsSearchViewTests(TestCase):
+    def test_search_by_playable_chords(self):
+        """
+        Searching by chords should return the songs whose chords are all in
+        the given set, and only those.
+        """
+        for title, content in [('Song1', 'G C D\nla la'),
+                               ('Song2', 'G Bm\nla la'),
+                               ('Song3', 'Em Eb\nla la'),
+                               ('Song4', 'la la')]:
+            song = create_song(title=title, published=True)
+            song.content = content
+            song.save()
+
+        for k in ['G C D Em D#', 'g, c, d, em, eb, a']:
+            response = self.client.get(reverse('chords:search'), {
+                'searchBy' : SearchForm.SEARCH_CHORDS, 'keywords' : k})
+            self.assertQuerysetEqual(response.context['results'],
+                                     ['<Song: Song1>', '<Song: Song3>'])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_search_after_reindexing(self):
+        """
+        Songs analyzed by the reindex_songs command should be found at once,
+        and the cached copies of them should carry the new analysis.
+        """
+        cache.clear()
+        song = create_song(title='Song1', published=True)
+        song.content = 'G C D\nla la'
+        song.save()
+        # a song stored before the chord analysis existed
+        Song.objects.filter(id=song.id).update(chord_mask='', key='')
+        MyCache.bump_catalogue_version()
+
+        def search():
+            response = self.client.get(reverse('chords:search'), {
+                'searchBy' : SearchForm.SEARCH_CHORDS, 'keywords' : 'G C D'})
+            return response.context['results']
+
+        self.assertEqual(search(), [])
+        self.assertEqual(MyCache.song(song.slug).key, '')
+
+        call_command('reindex_songs', stdout=StringIO())
+        self.assertEqual(search(), [song])
+        self.assertEqual(MyCache.song(song.slug).key, song.key)
+        self.assertNotEqual(song.key, '')
+
+    def test_search_easy_songs(self):
+        """
+        The easy filter should exclude songs needing barre chords at their
+        easiest semitone change.
+        """
+        for title, content in [('Song1', 'F Bb C\nla la'),
+                               ('Song2', 'F Bm C\nla la')]:
+            song = create_song(title=title, published=True)
+            song.content = content
+            song.save()
+
+        response = self.client.get(reverse('chords:search'), {
+            'searchBy' : SearchForm.SEARCH_SONG, 'keywords' : 'song',
+            'easy' : 'on'})
+        self.assertQuerysetEqual(response.context['results'], ['<Song: Song1>'])
+
+
 class RecentlyAddedViewTests(TestCase):
     @override_settings(CACHES=settings.DUMMY_CACHE)
     def test_with_unpublished_song(self):
@@ -791,20 +1468,87 @@ class PopularViewTests(TestCase):
         """
         song1 = create_song(title='Song1', published=True)
         song2 = create_song(title='Song2', published=True)
-        song1.viewedBy.add(create_user(username='user1'))
+        SongView.record(song1.id, create_user(username='user1'))
 
         response = self.client.get(reverse('chords:popular'))
         self.assertQuerysetEqual(response.context['songs'],
                                  ['<Song: Song1>', '<Song: Song2>'])
 
-        song2.viewedBy.add(create_user(username='user2'))
-        song2.viewedBy.add(create_user(username='user3'))
+        SongView.record(song2.id, create_user(username='user2'))
+        SongView.record(song2.id, create_user(username='user3'))
 
         response = self.client.get(reverse('chords:popular'))
         self.assertQuerysetEqual(response.context['songs'],
                                  ['<Song: Song2>', '<Song: Song1>'])
 
 
+class TrendingViewTests(TestCase):
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_recent_views_weigh_more(self):
+        """
+        A song viewed recently must rank above a song that was viewed more
+        times days ago, and unpublished songs must not be displayed.
+        """
+        cache.clear()
+        old = create_song(title='Old')
+        recent = create_song(title='Recent')
+        hidden = create_song(title='Hidden')
+        now = timezone.now()
+        SongViewBucket.objects.create(song=old, views=10,
+                                      hour=now - datetime.timedelta(days=4))
+        SongViewBucket.objects.create(song=hidden, views=50, hour=now)
+        hidden.unpublish()
+        for _ in range(2):
+            self.client.get(reverse('chords:song', args=(recent.slug,)))
+        self.assertEqual(SongViewBucket.objects.get(song=recent).views, 2)
+
+        call_command('rollup_trending', stdout=StringIO())
+        response = self.client.get(reverse('chords:trending'))
+        self.assertEqual(response.context['songs'], [recent, old])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_served_from_cache(self):
+        """
+        The trending view must use the ranking of the last rollup.
+        """
+        cache.clear()
+        song = create_song()
+        call_command('rollup_trending', stdout=StringIO())
+        self.client.get(reverse('chords:song', args=(song.slug,)))
+        response = self.client.get(reverse('chords:trending'))
+        self.assertEqual(response.context['songs'], [])
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_page_cached_until_the_rollup(self):
+        """
+        The trending page must be served from the page cache until the next
+        rollup ranks the songs again.
+        """
+        cache.clear()
+        song = create_song(title='Trendy')
+        call_command('rollup_trending', stdout=StringIO())
+        SongViewBucket.record(song.id)
+        self.assertNotContains(self.client.get(reverse('chords:trending')),
+                               'Trendy')
+
+        call_command('rollup_trending', stdout=StringIO())
+        self.client.get(reverse('chords:trending'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('chords:trending'))
+        self.assertContains(response, 'Trendy')
+
+    def test_rollup_prunes_expired_buckets(self):
+        """
+        The rollup must delete the buckets older than the retention period.
+        """
+        song = create_song()
+        SongViewBucket.objects.create(song=song, views=1,
+            hour=timezone.now() - SongViewBucket.RETENTION
+                 - datetime.timedelta(hours=1))
+        call_command('rollup_trending', stdout=StringIO())
+        self.assertFalse(SongViewBucket.objects.exists())
+
+
 class ContactViewTests(LoginedTestCase):
     def test_with_valid_data(self):
         """
@@ -844,3 +1588,390 @@ class ContactViewTests(LoginedTestCase):
                 valid_contact_data(body=''))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, 'This field is required.')
+
+
+@override_settings(CACHES=settings.LOCMEM_CACHE)
+class AnonymousPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.artist = create_artist(name='Artist')
+        self.song = create_song(title='Song', artist=self.artist)
+        self.song_url = reverse('chords:song', args=(self.song.slug,))
+        self.artist_url = reverse('chords:artist', args=(self.artist.slug,))
+
+    def test_served_without_queries(self):
+        """
+        Anonymous pages must be served from the cache on later requests, the
+        song page only counting the view for the trending songs.
+        """
+        self.client.get(self.artist_url)
+        self.client.get(self.song_url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.artist_url)
+        self.assertContains(response, 'Song')
+        with self.assertNumQueries(1):
+            response = self.client.get(self.song_url)
+        self.assertContains(response, 'Song')
+        self.assertEqual(SongViewBucket.objects.get(song=self.song).views, 2)
+
+    def test_keyed_on_the_parameters_the_page_reads(self):
+        """
+        Only the query parameters a page reads must make a separate copy of
+        it in the cache, in any order, and any other parameter must bypass
+        the cache.
+        """
+        self.client.get(self.artist_url, {'x' : 1})
+        self.assertIsNone(MyCache.cached_page(self.artist_url + '?x=1'))
+
+        calls = []
+        @page_cache(params=('page', 'sort'))
+        def view(request):
+            calls.append(request)
+            tag_page(request, [MyCache.Tags.INDEX])
+            return HttpResponse(str(len(calls)))
+
+        def get(url):
+            request = RequestFactory().get(url)
+            request.user = AnonymousUser()
+            return view(request).content.decode()
+
+        self.assertEqual(get('/list?page=2&sort=name'), '1')
+        self.assertEqual(get('/list?sort=name&page=2'), '1')
+        self.assertEqual(get('/list?page=2&sort=name&x=1'), '2')
+        self.assertEqual(get('/list?page=2&sort=name&x=1'), '3')
+        self.assertEqual(get('/list?page=3'), '4')
+        self.assertEqual(get('/list?page=3'), '4')
+
+    def test_song_save_purges_its_pages(self):
+        """
+        Saving a song must purge its page, its artist page and the lists.
+        """
+        for url in [self.song_url, self.artist_url, reverse('chords:index')]:
+            self.client.get(url)
+        self.song.title = 'Renamed'
+        self.song.save()
+        for url in [self.song_url, self.artist_url, reverse('chords:index')]:
+            self.assertContains(self.client.get(url), 'Renamed')
+
+    def test_song_moved_purges_the_old_artist_page(self):
+        """
+        Moving a song to another artist must purge the page of the old
+        artist as well as the new one.
+        """
+        self.client.get(self.artist_url)
+        song = Song.objects.get(id=self.song.id)
+        song.artist = create_artist(name='Other')
+        song.save()
+        self.assertNotContains(self.client.get(self.artist_url),
+                               self.song_url)
+
+    def test_comment_purges_song_page(self):
+        """
+        A new comment must purge only the page of its song.
+        """
+        self.client.get(self.song_url)
+        self.client.get(self.artist_url)
+        Comment(song=self.song, user=create_user(), content='Nice song').save()
+        self.assertContains(self.client.get(self.song_url), 'Nice song')
+        with self.assertNumQueries(0):
+            self.client.get(self.artist_url)
+
+    def test_artist_save_purges_its_song_pages(self):
+        """
+        Renaming an artist must purge the artist page and its song pages.
+        """
+        self.client.get(self.song_url)
+        self.client.get(self.artist_url)
+        self.artist.name = 'Renamed'
+        self.artist.save()
+        self.assertContains(self.client.get(self.song_url), 'Renamed')
+        self.assertContains(self.client.get(self.artist_url), 'Renamed')
+
+    def test_publish_purges_lists(self):
+        """
+        Publishing and unpublishing songs must purge the song lists and the
+        pages of the songs.
+        """
+        self.client.get(reverse('chords:recently_added'))
+        song = create_song(title='Pending', published=False)
+        song.publish()
+        self.assertContains(self.client.get(reverse('chords:recently_added')),
+                            'Pending')
+        Song.objects.filter(id=self.song.id).unpublish()
+        self.assertEqual(self.client.get(self.song_url).status_code, 404)
+
+    def test_not_used_for_logged_in_users(self):
+        """
+        Logged in users must get freshly rendered personalized pages.
+        """
+        self.client.get(self.artist_url)
+        create_user(password='password')
+        self.client.login(username='username', password='password')
+        response = self.client.get(self.artist_url)
+        self.assertContains(response, 'username')
+
+
+class SitemapViewTests(TestCase):
+    def test_sitemap_index_lists_sections(self):
+        """
+        The sitemap index should link to every sitemap section.
+        """
+        response = self.client.get('/sitemap.xml')
+        self.assertEqual(response.status_code, 200)
+        for section in ['static', 'songs', 'artists', 'users']:
+            self.assertContains(response, 'sitemap-{0}.xml'.format(section))
+
+    def test_songs_section_with_published_and_unpublished_song(self):
+        """
+        The songs section should only contain published songs.
+        """
+        song_pub = create_song(title='Song Published', published=True)
+        song_unpub = create_song(title='Song Unpublished', published=False)
+        response = self.client.get('/sitemap-songs.xml')
+        self.assertContains(response, song_pub.get_absolute_url())
+        self.assertNotContains(response, song_unpub.get_absolute_url())
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_songs_section_is_invalidated_when_a_song_changes(self):
+        """
+        A cached songs section must be rendered again after a song in its
+        range gets published.
+        """
+        cache.clear()
+        song = create_song(title='Random Song', published=False)
+        response = self.client.get('/sitemap-songs.xml')
+        self.assertNotContains(response, song.get_absolute_url())
+
+        song.publish()
+        response = self.client.get('/sitemap-songs.xml')
+        self.assertContains(response, song.get_absolute_url())
+
+    def test_section_out_of_range(self):
+        """
+        Requesting a section page past the last one should return a 404.
+        """
+        response = self.client.get('/sitemap-songs.xml?p=2')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/sitemap-songs.xml?p=a')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=settings.LOCMEM_CACHE)
+class SongAdminCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.artist = create_artist(name='Artist')
+        self.song = create_song(title='Song', artist=self.artist)
+
+    def test_purged_again_after_the_admin_transaction(self):
+        """
+        Saving or deleting a song in the admin must invalidate its caches
+        once more after the transaction, for the new artist and the old.
+        """
+        other = create_artist(name='Other')
+        data = {'title' : 'Renamed', 'artist' : other.id,
+                'genre' : self.song.genre, 'content' : 'content',
+                'video' : '', 'sender' : '', 'published' : 'on'}
+        with mock.patch.object(MyCache, 'purge_song',
+                               wraps=MyCache.purge_song) as purge_song:
+            self.client.post(reverse('admin:chords_song_change',
+                                     args=(self.song.id,)), data)
+        purge_song.assert_called_once_with(
+                self.song.id, self.song.slug, {self.artist.id, other.id})
+        self.assertEqual(MyCache.song(self.song.slug).title, 'Renamed')
+
+        with mock.patch.object(MyCache, 'purge_song',
+                               wraps=MyCache.purge_song) as purge_song:
+            self.client.post(reverse('admin:chords_song_delete',
+                                     args=(self.song.id,)), {'post' : 'yes'})
+        purge_song.assert_called_once_with(
+                self.song.id, self.song.slug, {other.id})
+        self.assertIsNone(MyCache.song(self.song.slug))
+
+
+class AdminSearchTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.artist = create_artist(name='Βασίλης Παπακωνσταντίνου')
+        self.other = create_artist(name='Other')
+        self.songs = [create_song(title='Love Song One', artist=self.other),
+                      create_song(title='Love Song Two', artist=self.other),
+                      create_song(title='Αγάπη μου', artist=self.artist,
+                                  published=False)]
+
+    def search(self, model, term):
+        response = self.client.get(reverse('admin:chords_{0}_changelist'.format(
+                model)), {'q' : term})
+        return list(response.context['cl'].result_list)
+
+    def test_artist_search(self):
+        """
+        The artist search must match the start of any word of the name, in
+        greek or in any latin spelling, and every word of the search term.
+        """
+        for term in ['papa', 'Παπα', 'vasilis', 'basilis', 'Βασ', 'vas papak']:
+            self.assertEqual(self.search('artist', term), [self.artist])
+        for term in ['asil', 'vasilis other']:
+            self.assertEqual(self.search('artist', term), [])
+
+    def test_artist_renamed(self):
+        """
+        A renamed artist must be found by the new name only.
+        """
+        self.other.name = 'Renamed'
+        self.other.save()
+        self.assertEqual(self.search('artist', 'ren'), [self.other])
+        self.assertEqual(self.search('artist', 'oth'), [])
+
+    def test_song_search(self):
+        """
+        The song search must match the start of any word of the title or of
+        the artist name, unpublished songs included.
+        """
+        self.assertEqual(set(self.search('song', 'song')), set(self.songs[:2]))
+        self.assertEqual(self.search('song', 'love two'), [self.songs[1]])
+        self.assertEqual(self.search('song', 'agapi'), [self.songs[2]])
+        self.assertEqual(self.search('song', 'papa'), [self.songs[2]])
+        self.assertEqual(set(self.search('song', 'other')), set(self.songs[:2]))
+        self.assertEqual(self.search('song', 'one two'), [])
+
+    def test_songs_with_their_artists(self):
+        """
+        The song changelist must fetch the artists of the songs in the same
+        query, so that its query count does not grow with the songs shown.
+        """
+        url = reverse('admin:chords_song_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        for i in range(5):
+            create_song(title='Song {0}'.format(i), artist=create_artist(
+                    name='Artist {0}'.format(i)))
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertContains(response, 'Artist 4')
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        for i in range(3):
+            create_song(title='Song {0}'.format(i))
+
+    def test_exact_count_on_other_databases(self):
+        """
+        Off PostgreSQL the paginator must count the rows as usual.
+        """
+        self.assertEqual(connection.vendor, 'sqlite')
+        self.assertEqual(EstimatedCountPaginator(Song.objects.all(), 2).count, 3)
+
+    @mock.patch('chords.admin.connections')
+    def test_estimated_count_on_postgresql(self, connections):
+        """
+        On PostgreSQL the paginator must take the number of rows of an
+        unfiltered queryset from the table statistics, and count filtered
+        querysets or tables without statistics.
+        """
+        connection = connections.__getitem__.return_value
+        connection.vendor = 'postgresql'
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = (1000.0,)
+        self.assertEqual(EstimatedCountPaginator(Song.objects.all(), 2).count, 1000)
+        cursor.execute.assert_called_once_with(
+                'SELECT reltuples FROM pg_class WHERE relname = %s',
+                [Song._meta.db_table])
+
+        songs = Song.objects.filter(title='Song 1')
+        self.assertEqual(EstimatedCountPaginator(songs, 2).count, 1)
+
+        cursor.fetchone.return_value = (0.0,)
+        self.assertEqual(EstimatedCountPaginator(Song.objects.all(), 2).count, 3)
+
+
+class DuplicatesAdminViewTests(TestCase):
+    def test_duplicates_report(self):
+        """
+        The admin duplicates report must list near-duplicate songs to staff.
+        """
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        for title in ['Original', 'Copy']:
+            song = create_song(title=title)
+            song.content = ' '.join('word{0}'.format(i) for i in range(40))
+            song.save()
+        response = self.client.get(reverse('admin:chords_song_duplicates'))
+        self.assertContains(response, 'Original')
+        self.assertContains(response, 'Copy')
+        self.assertContains(response, '100%')
+
+
+class ThreadedRequestsTests(TransactionTestCase):
+    """
+    Serve requests from several threads at once, the way a threaded WSGI
+    worker does, and check that no request sees the state of another.
+    """
+    THREADS = 8
+
+    def run_threads(self, func, args):
+        def run(arg):
+            try:
+                return func(arg)
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(max_workers=self.THREADS) as executor:
+            return list(executor.map(run, args))
+
+    def test_concurrent_comments(self):
+        """
+        Only the sessions that solved the captcha may skip it, however the
+        requests of the other sessions are interleaved with theirs.
+        """
+        song = create_song()
+        clients = []
+        for i in range(self.THREADS):
+            user = create_user(username='user{0}'.format(i))
+            client = Client()
+            client.login(username=user.username, password='password')
+            if i % 2 == 0:
+                session = client.session
+                session[CAPTCHA_PASSED_SESSION_KEY] = True
+                session.save()
+            clients.append((i, client, user))
+
+        def post_comments(args):
+            i, client, user = args
+            data = {'user' : user.id, 'song' : song.id, 'content' : 'comment',
+                    'g-recaptcha-response' : 'wrong', 'testing' : 'True'}
+            return [client.post(reverse('chords:add_comment'), data).status_code
+                    for _ in range(5)]
+
+        with solve_captcha(valid=False):
+            results = self.run_threads(post_comments, clients)
+
+        for i, codes in enumerate(results):
+            self.assertEqual(codes, [200 if i % 2 == 0 else 400] * 5)
+        self.assertEqual(song.comments.count(), self.THREADS // 2 * 5)
+
+    @override_settings(CACHES=settings.LOCMEM_CACHE)
+    def test_concurrent_song_reads_and_writes(self):
+        """
+        Readers of the hot songs must always get a whole song, while another
+        thread keeps changing it.
+        """
+        cache.clear()
+        MyCache.HOT_SONGS.clear()
+        song = create_song(title='Title 0')
+
+        def read_or_write(i):
+            if i == 0:
+                for n in range(1, 21):
+                    song.title = 'Title {0}'.format(n)
+                    song.save()
+                return []
+            return [MyCache.song(song.slug).title for _ in range(50)]
+
+        results = self.run_threads(read_or_write, range(self.THREADS))
+        titles = {title for titles in results for title in titles}
+        self.assertTrue(titles <= {'Title {0}'.format(n) for n in range(21)})
+        self.assertEqual(MyCache.song(song.slug).title, 'Title 20')
@@ -1,5 +1,11 @@
 import re
+import zlib
+import random
 import itertools
+import threading
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
 
 from django.template.defaultfilters import slugify
 
@@ -36,6 +42,266 @@ def greek_to_english(string):
 def slugify_greek(string):
     return slugify(greek_to_english(string))
 
+def greeklish_normalize(string):
+    """
+    Converts a string to a canonical greeklish form, in which the letters
+    and digraphs that people use interchangeably when writing greek with
+    latin characters are mapped to the same letter. For example both
+    "agapi" and "aghapi" become "agapi", and "oy" becomes "u".
+    """
+    VARIANTS = [
+        ('th', '8'), ('ch', 'x'), ('kh', 'x'), ('gh', 'g'), ('ps', '4'),
+        ('ou', 'u'), ('oy', 'u'), ('ei', 'i'), ('oi', 'i'), ('ai', 'e'),
+        ('h', 'i'), ('y', 'i'), ('w', 'o'), ('v', 'b'),
+    ]
+
+    string = slugify_greek(string).replace('-', ' ')
+    for variant, letter in VARIANTS:
+        string = string.replace(variant, letter)
+    return string
+
+def trigrams(string):
+    """
+    Returns the set of trigrams of the greeklish normalized words of the
+    string. Words are padded with two spaces in front and one at the end,
+    so that word beginnings weigh more than their endings.
+    """
+    grams = set()
+    for word in greeklish_normalize(string).split():
+        word = '  ' + word + ' '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+CHORD_REGEX = re.compile(
+    r'[A-G][#b]?(maj|m|aug|dim|sus|add)?([245679]|11|13)?[#b]?([245679]|11|13)?')
+TAB_LINE_REGEX = re.compile(r'^[A-Ga-g]:*\|{0,2}.*-.*-.*-.*-')
+
+def is_tab_line(line):
+    """
+    Checks whether a song line contains tablatures. Same as isTabLine() in
+    song.js.
+    """
+    return bool(TAB_LINE_REGEX.match(line))
+
+def is_chord_line(line):
+    """
+    Checks whether a song line contains only chords, the same way
+    parseChords() in song.js does.
+    """
+    if not CHORD_REGEX.search(line):
+        return False
+    return not re.search(r'[^\s()/|x\d]', CHORD_REGEX.sub('', line))
+
+# the chords we have diagrams for, see static/chords/img/chords
+CHORD_ROOTS = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+CHORD_TYPES = ['', '5', '6', '7', '9', '11', '13', 'm', 'm6', 'm7', 'm9', 'm11',
+               'm13', 'aug', 'aug7', 'aug9', 'dim', 'dim7', 'sus2', 'sus4']
+CHORD_VOCABULARY = [root + chord_type for root in CHORD_ROOTS
+                                      for chord_type in CHORD_TYPES]
+CHORD_BITS = {chord : bit for bit, chord in enumerate(CHORD_VOCABULARY)}
+# set in the mask of songs having chords outside the vocabulary
+UNKNOWN_CHORD_BIT = len(CHORD_VOCABULARY)
+
+def normalize_chord(chord):
+    """
+    If chord is a flat chord, return its non-flat equivalent.
+    Else, return the chord unchanged. Same as alterFlatChords() in song.js.
+
+    eg. "Ab" -> "G#", "Cb" -> "B", "G" -> "G"
+    """
+    FLATS = {'Ab' : 'G#', 'Bb' : 'A#', 'Cb' : 'B', 'Db' : 'C#', 'Eb' : 'D#',
+             'Fb' : 'E', 'Gb' : 'F#'}
+    if chord[:2] in FLATS:
+        return FLATS[chord[:2]] + chord[2:]
+    return chord
+
+def extract_chords(content):
+    """
+    Returns the list of the chords of the chord lines of a song, in order of
+    appearance and with flats converted to sharps.
+    """
+    chords = []
+    for line in content.splitlines():
+        if not is_tab_line(line) and is_chord_line(line):
+            chords.extend(normalize_chord(match.group(0))
+                          for match in CHORD_REGEX.finditer(line))
+    return chords
+
+def chords_mask(chords):
+    """
+    Returns an int with the bits of the given chords set, according to their
+    position in CHORD_VOCABULARY.
+    """
+    mask = 0
+    for chord in chords:
+        mask |= 1 << CHORD_BITS.get(chord, UNKNOWN_CHORD_BIT)
+    return mask
+
+# chord shapes that can be played without a barre
+OPEN_CHORDS = {
+    'A', 'A7', 'Am', 'Am7', 'Asus2', 'Asus4', 'B7', 'C', 'C7', 'D', 'D7',
+    'Dm', 'Dm7', 'Dsus2', 'Dsus4', 'E', 'E7', 'Em', 'Em7', 'Esus4', 'G', 'G7',
+}
+
+def split_chord(chord):
+    """
+    Splits a normalized chord to its root and type, eg. "F#m7" -> ("F#", "m7").
+    """
+    root = chord[:2] if chord[1:2] == '#' else chord[:1]
+    return root, chord[len(root):]
+
+def transpose_chord(chord, semitones):
+    """
+    Returns the given normalized chord, changed by the given number of
+    semitones. Same as changeSemiton() in song.js.
+    """
+    root, chord_type = split_chord(chord)
+    index = (CHORD_ROOTS.index(root) + semitones) % len(CHORD_ROOTS)
+    return CHORD_ROOTS[index] + chord_type
+
+def chord_quality(chord_type):
+    if chord_type.startswith('dim'):
+        return 'dim'
+    if chord_type.startswith('m') and not chord_type.startswith('maj'):
+        return 'min'
+    return 'maj'
+
+def detect_key(chords):
+    """
+    Guesses the key of a song from its normalized chords, in order of
+    appearance. Every key gets a point for each chord that belongs to its
+    scale, with extra points for its tonic and dominant and for songs that
+    start or end on its tonic. Returns the key as a chord name, eg. "G" or
+    "Em", or an empty string if there are no chords.
+    """
+    # (interval from the tonic, quality, weight) of the chords of each scale
+    SCALES = {
+        'maj' : [(0, 'maj', 3), (2, 'min', 1), (4, 'min', 1), (5, 'maj', 1),
+                 (7, 'maj', 2), (9, 'min', 1), (11, 'dim', 1)],
+        'min' : [(0, 'min', 3), (2, 'dim', 1), (3, 'maj', 1), (5, 'min', 1),
+                 (7, 'min', 2), (7, 'maj', 2), (8, 'maj', 1), (10, 'maj', 1)],
+    }
+
+    chords = [split_chord(chord) for chord in chords
+              if split_chord(chord)[0] in CHORD_ROOTS]
+    if not chords:
+        return ''
+
+    best_key, best_score = '', -1
+    for tonic in range(len(CHORD_ROOTS)):
+        for mode, scale in sorted(SCALES.items()):
+            weights = {((tonic + interval) % 12, quality) : weight
+                       for interval, quality, weight in scale}
+            score = 0
+            for root, chord_type in chords:
+                score += weights.get((CHORD_ROOTS.index(root),
+                                      chord_quality(chord_type)), 0)
+            for root, chord_type in (chords[0], chords[-1]):
+                if (CHORD_ROOTS.index(root) == tonic and
+                        chord_quality(chord_type) == mode):
+                    score += 3
+            if score > best_score:
+                best_key = CHORD_ROOTS[tonic] + ('m' if mode == 'min' else '')
+                best_score = score
+    return best_key
+
+def barre_chords(chords):
+    """
+    Returns the number of distinct chords that need a barre.
+    """
+    return len(set(chords) - OPEN_CHORDS)
+
+def best_shift(chords):
+    """
+    Returns the semitone change from -5 to 6, that makes a song easiest to
+    play, along with the number of barre chords it leaves. Among equally
+    easy changes, the smallest one wins.
+    """
+    chords = [chord for chord in set(chords)
+              if split_chord(chord)[0] in CHORD_ROOTS]
+    shifts = sorted(range(-5, 7), key=abs)
+    scores = [(barre_chords(transpose_chord(c, shift) for c in chords), shift)
+              for shift in shifts]
+    score, shift = min(scores, key=lambda pair: pair[0])
+    return shift, score
+
+def lyrics_words(content):
+    """
+    Returns the list of the greeklish normalized words of the lyrics of a
+    song, skipping chord and tab lines, as well as single letter words.
+    """
+    words = []
+    for line in content.splitlines():
+        if is_tab_line(line) or is_chord_line(line):
+            continue
+        words.extend(w for w in greeklish_normalize(line).split() if len(w) > 1)
+    return words
+
+# MinHash signatures of song contents, see minhash_signature(). Songs whose
+# signatures agree on all the rows of any band are duplicate candidates.
+# With 16 bands of 4 rows, songs that share half of their shingles become
+# candidates half of the time and songs that share 80% of them almost always.
+MINHASH_ROWS = 4
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 61) - 1
+
+def minhash_permutations(count, seed=0):
+    """
+    Returns count (a, b) pairs of the hash functions x -> (a * x + b) mod p
+    that stand in for the permutations of the shingles. They are seeded so
+    that signatures stay comparable across processes and restarts.
+    """
+    rng = random.Random(seed)
+    return [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+            for _ in range(count)]
+
+MINHASH_PERMUTATIONS = minhash_permutations(MINHASH_ROWS * MINHASH_BANDS)
+
+def content_shingles(content, size=3):
+    """
+    Returns the set of hashes of the runs of size consecutive greeklish
+    normalized words of a song, chords included, so that the same song sent
+    with small changes or under another title shares most of its shingles.
+    """
+    words = greeklish_normalize(content).split()
+    runs = (words[i:i + size] for i in range(max(len(words) - size + 1, 1)))
+    return {zlib.crc32(' '.join(run).encode('utf-8')) for run in runs if run}
+
+def minhash_signature(content):
+    """
+    Returns the MinHash signature of the shingles of a song as a string of
+    fixed width hex values, one per permutation, or an empty string for a
+    song without words.
+    """
+    shingles = content_shingles(content)
+    if not shingles:
+        return ''
+    return ''.join(
+        '{0:08x}'.format(min((a * x + b) % MINHASH_PRIME for x in shingles)
+                         & 0xffffffff)
+        for a, b in MINHASH_PERMUTATIONS)
+
+def minhash_bands(signature):
+    """
+    Returns the LSH buckets of a signature, each one made of the band number
+    and its rows.
+    """
+    width = MINHASH_ROWS * 8
+    return ['{0:x}:{1}'.format(band, signature[band * width:(band + 1) * width])
+            for band in range(len(signature) // width)]
+
+def minhash_similarity(signature1, signature2):
+    """
+    Returns the fraction of rows on which two signatures agree, which is an
+    estimate of the Jaccard similarity of the shingles of the two songs.
+    """
+    if not signature1 or len(signature1) != len(signature2):
+        return 0.0
+    rows = len(signature1) // 8
+    same = sum(signature1[i:i + 8] == signature2[i:i + 8]
+               for i in range(0, len(signature1), 8))
+    return same / rows
+
 def generate_unique_slug(cls, string, max_length=-1):
     """
     Creates a slug with the appropriate maximum length.
@@ -77,3 +343,67 @@ def strip_whitespace_lines(string):
         lines.pop()
 
     return '\n'.join(lines)
+
+
+class SortedIdSet:
+    """
+    A compact set of object ids, stored as a sorted array of unsigned ints.
+    Membership tests are binary searches and the whole set pickles to a few
+    bytes per id, which makes it cheap to keep in the cache.
+    """
+    def __init__(self, ids=()):
+        self.ids = array('I', sorted(set(ids)))
+
+    def __contains__(self, obj_id):
+        i = bisect_left(self.ids, obj_id)
+        return i != len(self.ids) and self.ids[i] == obj_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def version(self):
+        """
+        A checksum of the ids, which changes whenever the set changes.
+        """
+        return zlib.crc32(self.ids.tobytes())
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded mapping that evicts the least recently used
+    key when it is full. Meant for small per-process caches in front of the
+    shared cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
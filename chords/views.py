@@ -1,16 +1,25 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404
 from django.views.generic.edit import FormView
 from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
-from django.core.urlresolvers import reverse_lazy
+from django.views.decorators.http import require_POST
+from django.views.decorators.cache import never_cache
+from django.middleware.csrf import get_token
+from django.core.urlresolvers import reverse, reverse_lazy
+from django.core.paginator import Paginator, InvalidPage
+from django.db import transaction
 from django.db.models import Q
+from django.utils.http import urlencode
 
-import os
+from functools import wraps
 
-from .models import Artist, Song, Comment, User, MyCache
+from .models import (Artist, Song, Comment, User, LyricsWord, SongView,
+                     SongViewBucket, SongDraft, MyCache)
 from .forms import AddSongForm, AddCommentForm, ContactForm, SearchForm
 from .utils import slugify_greek
+from .indexes import (autocomplete_index, fuzzy_song_index, fuzzy_artist_index,
+                      chord_index)
 
 
 class LoginRequiredMixin(object):
@@ -20,45 +29,136 @@ class LoginRequiredMixin(object):
         return login_required(view)
 
 
+def page_cache(personalized=True, on_hit=None, params=()):
+    """
+    Serve GET requests from the page cache. The view declares what the page
+    depends on by calling tag_page(), and the page is cached only if it did
+    so and no CSRF token was rendered in it.
+
+    Keyword arguments:
+    personalized -- whether the page differs per user, in which case only
+                    the requests of anonymous users use the cache
+    on_hit       -- callable for the work that must happen even when the
+                    page is served from the cache. It is called with the
+                    request and the hit_args the view passed to tag_page().
+    params       -- the query parameters the page depends on. Requests with
+                    any other parameter bypass the cache, so that made up
+                    query strings cannot fill it with copies of the page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or (
+                    personalized and request.user.is_authenticated()) or (
+                    any(name not in params for name in request.GET)):
+                return view(request, *args, **kwargs)
+
+            # the same page whatever the order of the parameters
+            path = request.path
+            if request.GET:
+                path += '?' + urlencode(sorted(request.GET.lists()), doseq=True)
+            page = MyCache.cached_page(path)
+            if page is not None:
+                content, content_type, hit_args = page
+                if on_hit is not None:
+                    on_hit(request, *hit_args)
+                return HttpResponse(content, content_type=content_type)
+
+            request.page_tag_versions = {}
+            request.page_hit_args = ()
+            response = view(request, *args, **kwargs)
+            if (response.status_code == 200 and request.page_tag_versions and
+                    not request.META.get('CSRF_COOKIE_USED', False)):
+                MyCache.cache_page(path, response.content,
+                                   response['Content-Type'],
+                                   request.page_tag_versions,
+                                   request.page_hit_args)
+            return response
+        return wrapper
+    return decorator
+
+def tag_page(request, tags, hit_args=()):
+    """
+    Mark the page being rendered for the request as depending on the tags.
+    """
+    if hasattr(request, 'page_tag_versions'):
+        request.page_tag_versions.update(MyCache.page_tag_versions(tags))
+        request.page_hit_args = hit_args
+
+
+@page_cache()
 def index(request):
-    if 'song_data' in request.session:
-        del request.session['song_data']
-    context = {
-        'recent_songs' : MyCache.recent_songs()[:7],
-        'popular_songs' : MyCache.popular_songs()[:7],
-        'song_count' : MyCache.published_songs_count(),
-        'artist_count' : MyCache.artists_count(),
-        'user_count' : User.objects.count(),
-    }
-    return render(request, 'chords/index.html', context)
+    discard_song_draft(request)
+    tag_page(request, MyCache.Tags.SONG_LISTS)
+    return render(request, 'chords/index.html', MyCache.homepage())
+
+def get_song_or_404(request, song_slug, own=True):
+    """
+    Return the song of the slug, through the song cache, if it is published
+    or, when own is True, sent by the current user.
+    """
+    song = MyCache.song(song_slug)
+    if song is None:
+        raise Http404('No song matches the given query.')
+    if not song.published and not (own and request.user.is_authenticated() and
+                                   song.sender_id == request.user.id):
+        raise Http404('No song matches the given query.')
+    return song
+
+def song_viewed(request, song_id, published=True):
+    """
+    Count a view of the song for the trending songs and, for logged in users,
+    in their view log and recently viewed songs.
+    """
+    if published:
+        SongViewBucket.record(song_id)
+    if request.user.is_authenticated():
+        SongView.record(song_id, request.user)
+        MyCache.add_recently_viewed(request.user, song_id)
 
+# the page is the same for everyone, the parts that depend on the user are
+# filled in by song.js from song_user_state()
+@page_cache(personalized=False, on_hit=song_viewed)
 def song(request, song_slug):
-    context = {}
-    if request.user.is_authenticated():
-        song = get_object_or_404(Song, Q(slug=song_slug),
-            Q(published=True) | Q(sender=request.user))
-        song.viewedBy.add(request.user)
+    song = get_song_or_404(request, song_slug)
 
-        context['bookmarked'] = bool(request.user.bookmarks.filter(slug=song.slug))
-    else:
-        song = get_object_or_404(Song, slug=song_slug, published=True)
+    if song.published:
+        tag_page(request, song.page_tags(), hit_args=(song.id,))
+    song_viewed(request, song.id, song.published)
 
     comments = song.comments.all().order_by('pub_date')
-    comment_form = AddCommentForm(initial={
-        'user' : request.user.id,
-        'song' : song.id})
-    context.update({'song' : song, 'preview' : False,
-                    'comments' : comments, 'comment_form' : comment_form})
+    comment_form = AddCommentForm(initial={'song' : song.id})
+    context = {'song' : song, 'preview' : False,
+               'comments' : comments, 'comment_form' : comment_form,
+               'related_songs' : song.related_songs()}
     return render(request, 'chords/song.html', context)
 
+@never_cache
+def song_user_state(request, song_slug):
+    """
+    Return the parts of the song page that depend on the current user.
+    """
+    if not request.user.is_authenticated():
+        return JsonResponse({'user' : None})
+
+    song = get_song_or_404(request, song_slug)
+    return JsonResponse({
+        'user' : {'id' : request.user.id, 'username' : request.user.username},
+        'bookmarked' : song.id in MyCache.bookmarked_song_ids(request.user),
+        'csrf_token' : get_token(request),
+        'navbar' : render_to_string('chords/navbar_user.html',
+                                    {'user' : request.user}),
+    })
+
 def song_json(request, song_slug):
-    song = get_object_or_404(Song, slug=song_slug, published=True)
+    song = get_song_or_404(request, song_slug, own=False)
     return JsonResponse(song.tojson())
 
+@page_cache()
 def artist(request, artist_slug):
     artist = get_object_or_404(Artist, slug=artist_slug)
-    songs = artist.songs.filter(published=True).order_by('title')
-    context = {'artist' : artist, 'songs' : songs}
+    tag_page(request, [MyCache.Tags.ARTIST.format(artist.id)])
+    context = {'artist' : artist, 'songs' : MyCache.artist_songs(artist)}
     return render(request, 'chords/artist.html', context)
 
 def user(request, username):
@@ -72,66 +172,191 @@ def user(request, username):
     context = {'theuser' : user, 'songs' : songs}
     return render(request, 'chords/user.html', context)
 
+@page_cache()
 def popular(request):
+    tag_page(request, [MyCache.Tags.POPULAR])
     songs = MyCache.popular_songs()[:100]
     return render(request, 'chords/popular.html', {'songs' : songs})
 
+@page_cache()
+def trending(request):
+    tag_page(request, [MyCache.Tags.TRENDING])
+    songs = MyCache.trending_songs()
+    return render(request, 'chords/trending.html', {'songs' : songs})
+
+@page_cache()
 def recently_added(request):
+    tag_page(request, [MyCache.Tags.RECENTLY_ADDED])
     songs = MyCache.recent_songs()[:100]
     return render(request, 'chords/recently_added.html', {'songs' : songs})
 
+SEARCH_ORDER = {
+        SearchForm.SEARCH_ARTIST :
+            {'nameAsc' : 'name', 'nameDesc' : '-name'},
+        SearchForm.SEARCH_SONG :
+            {'nameAsc' : 'title', 'nameDesc' : '-title',
+             'artistAsc' : 'artist__name', 'artistDesc' : '-artist__name',
+             'genreAsc' : 'genre', 'genreDesc' : '-genre',
+             'tabsAsc' : '-tabs', 'tabsDesc' : 'tabs'},
+        SearchForm.SEARCH_USER :
+            {'nameAsc' : 'username', 'nameDesc' : '-username'},
+}
+SEARCH_ORDER[SearchForm.SEARCH_LYRICS] = SEARCH_ORDER[SearchForm.SEARCH_SONG]
+SEARCH_ORDER[SearchForm.SEARCH_CHORDS] = SEARCH_ORDER[SearchForm.SEARCH_SONG]
+
+SEARCH_RESULTS_LIMIT = 500
+SEARCH_RESULTS_PER_PAGE = 50
+
+def search_model(searchBy):
+    if searchBy == SearchForm.SEARCH_ARTIST:
+        return Artist
+    elif searchBy == SearchForm.SEARCH_USER:
+        return User
+    return Song
+
+def find_search_results(searchBy, keywords, genre, tabs, fuzzy, easy):
+    """
+    Return a dict with the ids of up to SEARCH_RESULTS_LIMIT results of a
+    search in their default order (the best matches first for ranked
+    searches, by name otherwise), whether there were more of them and, for
+    song searches, the genre and tabs facets of the songs matching the
+    keywords.
+    """
+    keyword_slug = slugify_greek(keywords)
+    # ids of the ranked matches, the best first
+    ranked_ids = None
+    facets = None
+
+    if searchBy == SearchForm.SEARCH_ARTIST:
+        if fuzzy:
+            ranked_ids = fuzzy_artist_index.search(keywords)
+            results = Artist.objects.filter(id__in=ranked_ids)
+        else:
+            results = Artist.objects.filter(slug__contains=keyword_slug)
+    elif searchBy != SearchForm.SEARCH_USER:
+        if searchBy == SearchForm.SEARCH_LYRICS:
+            ranked_ids = LyricsWord.search(keywords)
+            results = Song.objects.filter(id__in=ranked_ids, published=True)
+        elif searchBy == SearchForm.SEARCH_CHORDS:
+            ranked_ids = chord_index.search(keywords)
+            results = Song.objects.filter(id__in=ranked_ids, published=True)
+        elif fuzzy:
+            ranked_ids = fuzzy_song_index.search(keywords)
+            results = Song.objects.filter(id__in=ranked_ids, published=True)
+        else:
+            results = Song.objects.filter(
+                    slug__contains=keyword_slug, published=True)
+
+        facets = results.facets()
+        if genre != SearchForm.GENRE_ALL:
+            results = results.filter(genre=genre)
+        if tabs == SearchForm.CHORDS_ONLY:
+            results = results.filter(tabs=False)
+        if easy:
+            results = results.filter(barre_chords=0)
+    else:
+        results = User.objects.filter(username__icontains=keywords)
+
+    if ranked_ids is not None:
+        found = set(results.values_list('id', flat=True))
+        ids = [obj_id for obj_id in ranked_ids if obj_id in found]
+    else:
+        results = results.order_by(SEARCH_ORDER[searchBy]['nameAsc'])
+        ids = list(results.values_list('id', flat=True)[:SEARCH_RESULTS_LIMIT + 1])
+    return {'ids' : ids[:SEARCH_RESULTS_LIMIT], 'facets' : facets,
+            'truncated' : len(ids) > SEARCH_RESULTS_LIMIT}
+
 def search(request):
     searchBy = request.GET.get('searchBy', SearchForm.SEARCH_SONG)
-    keywords = request.GET.get('keywords', '')
+    # normalized once, the cache key and the query must agree on it
+    keywords = request.GET.get('keywords', '').strip()
     genre = request.GET.get('genre', SearchForm.GENRE_ALL)
     tabs = request.GET.get('tabs', SearchForm.INCLUDE_TABS)
+    fuzzy = bool(request.GET.get('fuzzy', ''))
+    easy = bool(request.GET.get('easy', ''))
     orderBy = request.GET.get('orderBy', '')
 
     form = SearchForm(initial={'searchBy' : searchBy, 'keywords' : keywords,
-                               'genre' : genre, 'tabs' : tabs})
+                               'genre' : genre, 'tabs' : tabs, 'fuzzy' : fuzzy,
+                               'easy' : easy})
     context = {'form' : form}
 
     if keywords:
-        keyword_slug = slugify_greek(keywords)
-
-        if searchBy == SearchForm.SEARCH_ARTIST:
-            context['searchBy'] = 'artist'
-            results = Artist.objects.filter(slug__contains=keyword_slug)
-        elif searchBy == SearchForm.SEARCH_SONG:
-            context['searchBy'] = 'song'
-            results = Song.objects.filter(
-                    slug__contains=keyword_slug, published=True)
-
-            if genre != SearchForm.GENRE_ALL:
-                results = results.filter(genre=genre)
-            if tabs == SearchForm.CHORDS_ONLY:
-                results = results.filter(tabs=False)
+        if searchBy not in SEARCH_ORDER:
+            searchBy = SearchForm.SEARCH_USER
+        context['searchBy'] = {
+            SearchForm.SEARCH_ARTIST : 'artist',
+            SearchForm.SEARCH_USER : 'user',
+        }.get(searchBy, 'song')
+
+        # normalize the query, so that equivalent searches share the cache
+        if searchBy == SearchForm.SEARCH_USER:
+            query = (searchBy, keywords)
+        elif searchBy == SearchForm.SEARCH_ARTIST:
+            query = (searchBy, slugify_greek(keywords), fuzzy)
+        elif searchBy == SearchForm.SEARCH_CHORDS:
+            query = (searchBy, tuple(sorted(set(chord_index.parse(keywords)))),
+                     genre, tabs == SearchForm.CHORDS_ONLY, easy)
         else:
-            context['searchBy'] = 'user'
-            results = User.objects.filter(username__icontains=keywords)
-
-        order_dict = {
-                SearchForm.SEARCH_ARTIST :
-                    {'nameAsc' : 'name', 'nameDesc' : '-name'},
-                SearchForm.SEARCH_SONG :
-                    {'nameAsc' : 'title', 'nameDesc' : '-title',
-                     'artistAsc' : 'artist__name', 'artistDesc' : '-artist__name',
-                     'genreAsc' : 'genre', 'genreDesc' : '-genre',
-                     'tabsAsc' : '-tabs', 'tabsDesc' : 'tabs'},
-                SearchForm.SEARCH_USER :
-                    {'nameAsc' : 'username', 'nameDesc' : '-username'},
-        }
-
+            query = (searchBy, slugify_greek(keywords), fuzzy, genre,
+                     tabs == SearchForm.CHORDS_ONLY, easy)
+        namespace = (MyCache.Namespaces.USERNAMES
+                     if searchBy == SearchForm.SEARCH_USER
+                     else MyCache.Namespaces.CATALOGUE)
+        found = MyCache.search_results(query, lambda: find_search_results(
+                searchBy, keywords, genre, tabs, fuzzy, easy), namespace)
+        ids = found['ids']
+        if found['facets'] is not None:
+            form.show_facets(found['facets'])
+
+        model = search_model(searchBy)
+        if orderBy not in SEARCH_ORDER[searchBy]:
+            orderBy = ''
         if orderBy:
-            context['results'] = results.order_by(order_dict[searchBy][orderBy])
+            ids = list(model.objects.filter(id__in=ids).order_by(
+                    SEARCH_ORDER[searchBy][orderBy]).values_list('id', flat=True))
+
+        paginator = Paginator(ids, SEARCH_RESULTS_PER_PAGE)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except InvalidPage:
+            page = paginator.page(1)
+
+        objects = model.objects.all()
+        if model == Song:
+            # the cached ids may still hold songs unpublished since
+            objects = objects.filter(published=True).select_related('artist')
+        objects = objects.in_bulk(page.object_list)
+        results = [objects[obj_id] for obj_id in page.object_list
+                   if obj_id in objects]
+        context['results'] = results
+
+        # the table is sorted again in place, see search_order_ajax.js
+        if request.is_ajax():
             html = render_to_string('chords/search_results_body.html', context)
             return HttpResponse(html)
 
-        results = results.order_by(order_dict[searchBy]['nameAsc'])
-        context.update({'results' : results, 'query' : keywords})
+        # the page links keep the order, which is part of the query string
+        query_string = request.GET.copy()
+        query_string.pop('page', None)
+        context.update({'query' : keywords, 'page' : page, 'orderBy' : orderBy,
+                        'truncated' : found.get('truncated', False),
+                        'query_string' : query_string.urlencode()})
 
     return render(request, 'chords/search.html', context)
 
+def autocomplete(request):
+    urls = {
+        autocomplete_index.SONG : 'chords:song',
+        autocomplete_index.ARTIST : 'chords:artist',
+        autocomplete_index.USER : 'chords:user',
+    }
+    results = []
+    for kind, name, slug in autocomplete_index.lookup(request.GET.get('q', '')):
+        results.append({'type' : kind, 'name' : name,
+                        'url' : reverse(urls[kind], args=(slug,))})
+    return JsonResponse({'results' : results})
+
 class ContactView(FormView):
     form_class = ContactForm
     template_name = 'chords/contact.html'
@@ -149,18 +374,17 @@ class ContactView(FormView):
 def contact_done(request):
     return render(request, 'chords/contact_done.html', {})
 
+CAPTCHA_PASSED_SESSION_KEY = 'captcha_passed'
+
 class AddCommentView(LoginRequiredMixin, FormView):
     form_class = AddCommentForm
     template_name = 'chords/display_comment.html'
 
     def post(self, request, *args, **kwargs):
-        if request.POST.get('testing', '') == 'True':
-            os.environ['RECAPTCHA_TESTING'] = 'True'
-            request.POST._mutable = True
-            request.POST['g-recaptcha-response'] = 'PASSED'
-            request.POST._mutable = False
-
-        form = self.form_class(request.POST)
+        # the captcha is only asked for the first comment of a session
+        require_captcha = not request.session.get(CAPTCHA_PASSED_SESSION_KEY,
+                                                  False)
+        form = self.form_class(request.POST, require_captcha=require_captcha)
 
         if form.is_valid():
             data = form.cleaned_data
@@ -168,7 +392,8 @@ class AddCommentView(LoginRequiredMixin, FormView):
                               content=data['content'])
             comment.save()
 
-            os.environ['RECAPTCHA_TESTING'] = 'False'
+            if require_captcha:
+                request.session[CAPTCHA_PASSED_SESSION_KEY] = True
             return HttpResponse(render_to_string(self.template_name,
                                                  {'comment' : comment}))
 
@@ -176,17 +401,42 @@ class AddCommentView(LoginRequiredMixin, FormView):
 
 @login_required
 def add_bookmark(request, song_slug):
-    song = get_object_or_404(Song, Q(slug=song_slug),
-        Q(published=True) | Q(sender=request.user))
-    request.user.bookmarks.add(song)
+    song = get_song_or_404(request, song_slug)
+    MyCache.add_bookmarks(request.user, [song])
     return HttpResponse()
 
 @login_required
 def remove_bookmark(request, song_slug):
     song = get_object_or_404(Song, slug=song_slug)
-    request.user.bookmarks.remove(song)
+    MyCache.remove_bookmarks(request.user, [song])
     return HttpResponse()
 
+@require_POST
+@login_required
+def sync_bookmarks(request):
+    """
+    Add and remove many bookmarks at once. Expects the slugs of the songs in
+    the `add` and `remove` lists of the POST data and returns the version of
+    the resulting bookmarks set.
+    """
+    add_songs = list(Song.objects.filter(
+        Q(slug__in=request.POST.getlist('add')),
+        Q(published=True) | Q(sender=request.user)))
+    remove_songs = list(Song.objects.filter(
+        slug__in=request.POST.getlist('remove')))
+
+    with transaction.atomic():
+        if add_songs:
+            MyCache.add_bookmarks(request.user, add_songs)
+        if remove_songs:
+            MyCache.remove_bookmarks(request.user, remove_songs)
+    # once more after the commit, a concurrent request may have cached the
+    # bookmarks as they were before it
+    MyCache.delete_bookmarks(request.user)
+
+    version = MyCache.bookmarked_song_ids(request.user).version()
+    return JsonResponse({'version' : version})
+
 @login_required
 def bookmarks(request):
     songs = request.user.bookmarks.filter(
@@ -194,24 +444,60 @@ def bookmarks(request):
             ).order_by('artist__name', 'title')
     return render(request, 'chords/bookmarks.html', {'songs' : songs})
 
+@login_required
+def recently_viewed(request):
+    song_ids = MyCache.recently_viewed_song_ids(request.user)
+    # in_bulk() fetches them with a single pk__in query
+    songs = Song.objects.filter(
+            Q(published=True) | Q(sender=request.user)
+            ).select_related('artist').in_bulk(song_ids)
+    songs = [songs[song_id] for song_id in song_ids if song_id in songs]
+    return render(request, 'chords/recently_viewed.html', {'songs' : songs})
+
+SONG_DRAFT_SESSION_KEY = 'song_draft'
+
+def get_song_draft(request):
+    """
+    Return the song draft referenced by the session of the request, or None.
+    """
+    draft_id = request.session.get(SONG_DRAFT_SESSION_KEY, None)
+    if draft_id is None or not request.user.is_authenticated():
+        return None
+    return SongDraft.get_live(draft_id, request.user)
+
+def discard_song_draft(request):
+    # the session is only modified, and so saved, when there is a draft
+    if SONG_DRAFT_SESSION_KEY in request.session:
+        draft_id = request.session.pop(SONG_DRAFT_SESSION_KEY)
+        SongDraft.objects.filter(id=draft_id).delete()
+
 class AddSongView(LoginRequiredMixin, FormView):
     form_class = AddSongForm
     template_name = 'chords/add_song.html'
     success_url = reverse_lazy('chords:verify_song')
 
     def get_initial(self):
-        return self.request.session.get('song_data', None)
+        draft = get_song_draft(self.request)
+        return draft.get_data() if draft else None
 
     def form_valid(self, form):
-        self.request.session['song_data'] = form.cleaned_data
-        self.request.session['song_data']['user_txt'] = self.request.user.get_username()
+        data = dict(form.cleaned_data,
+                    user_txt=self.request.user.get_username())
+        draft = get_song_draft(self.request)
+        if draft is None:
+            draft = SongDraft(user=self.request.user)
+        draft.set_data(data)
+        draft.save()
+        if self.request.session.get(SONG_DRAFT_SESSION_KEY, None) != draft.id:
+            self.request.session[SONG_DRAFT_SESSION_KEY] = draft.id
         return super(AddSongView, self).form_valid(form)
 
 @login_required
 def verify_song(request):
-    song_data = request.session.get('song_data', None)
-    if song_data is None:
+    draft = get_song_draft(request)
+    if draft is None:
         return redirect('chords:add_song')
+    song_data = draft.get_data()
 
     song = Song(
         title=song_data['title'], artist=None, video=song_data['video'],
@@ -219,16 +505,20 @@ def verify_song(request):
         content=song_data['content'])
     if song.video:
         song.video = song.get_embed_video_url()
+    song.analyze_chords()
+    duplicates = song.probable_duplicates(Song.objects.filter(published=True))
 
     context = {'song' : song, 'artist_txt' : song_data['artist_txt'],
-               'user_txt' : song_data['user_txt'], 'preview' : True}
+               'user_txt' : song_data['user_txt'], 'preview' : True,
+               'duplicates' : duplicates}
     return render(request, 'chords/verify_song.html', context)
 
 @login_required
 def song_submitted(request):
-    song_data = request.session.get('song_data', None)
-    if song_data is None:
+    draft = get_song_draft(request)
+    if draft is None:
         return redirect('chords:add_song')
+    song_data = draft.get_data()
 
     try:
         artist = Artist.objects.get(slug=slugify_greek(song_data['artist_txt']))
@@ -242,5 +532,5 @@ def song_submitted(request):
         tabs=song_data['tabs'], content=song_data['content'])
     song.save()
 
-    del request.session['song_data']
+    discard_song_draft(request)
     return render(request, 'chords/song_submitted.html', {})
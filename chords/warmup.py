@@ -0,0 +1,67 @@
+import os
+
+from django.core.urlresolvers import reverse
+from django.template.loader import get_template
+
+from .models import MyCache
+from .indexes import (autocomplete_index, chord_index, fuzzy_song_index,
+                      fuzzy_artist_index)
+
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'templates')
+
+def template_names():
+    """
+    Return the names of all the templates of the app.
+    """
+    names = []
+    for root, dirs, files in os.walk(TEMPLATES_DIR):
+        for filename in files:
+            if filename.endswith('.html'):
+                path = os.path.relpath(os.path.join(root, filename), TEMPLATES_DIR)
+                names.append(path.replace(os.sep, '/'))
+    return sorted(names)
+
+def hot_songs(count):
+    """
+    Return the trending songs followed by the most popular ones, count at
+    most, without duplicates.
+    """
+    songs, seen = [], set()
+    for song in MyCache.trending_songs() + list(MyCache.popular_songs()[:count]):
+        if song.id not in seen:
+            seen.add(song.id)
+            songs.append(song)
+    return songs[:count]
+
+def warm_up(songs=20):
+    """
+    Fill the caches a worker needs to serve its first requests fast: the
+    shared MyCache entries, the in-process indexes, the compiled templates
+    (when the cached template loader is in use), the URL resolver and the
+    hottest songs. Return the number of warmed songs and templates.
+    """
+    MyCache.popular_songs()
+    MyCache.recent_songs()
+    MyCache.published_songs_count()
+    MyCache.artists_count()
+    MyCache.users_count()
+    MyCache.homepage()
+
+    for index in [autocomplete_index, chord_index, fuzzy_song_index,
+                  fuzzy_artist_index]:
+        index.refresh()
+
+    templates = template_names()
+    for name in templates:
+        get_template(name)
+
+    # populates the URL resolver
+    reverse('chords:index')
+
+    # through the song cache only, rendering the pages would count as views
+    hot = hot_songs(songs)
+    for song in hot:
+        MyCache.song(song.slug)
+    return len(hot), len(templates)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from .settings import BASE_DIR
 
 
@@ -13,6 +14,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # a file rather than the in-memory default, where the connections of
+        # the threaded tests fail on each other's locks instead of waiting.
+        # It is kept out of the tree, and named per process so that a file
+        # left behind by an interrupted run is not asked about by the next.
+        'TEST': {
+            'NAME': os.path.join(tempfile.gettempdir(),
+                                 'guitarchords_test_{0}.sqlite3'.format(
+                                     os.getpid())),
+        },
     }
 }
 
@@ -22,6 +32,13 @@ DUMMY_CACHE = {
     }
 }
 
+LOCMEM_CACHE = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'unique-snowflake',
+    }
+}
+
 CACHES = DUMMY_CACHE
 
 EMAIL_HOST = 'localhost'
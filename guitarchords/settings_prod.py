@@ -18,13 +18,21 @@ DATABASES = {
     }
 }
 
+# the cache must be shared by all the workers, the invalidation of cached
+# songs, pages and search indexes is only seen through it
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get('MEMCACHED_LOCATION', '127.0.0.1:11211'),
     }
 }
 
+# sessions only hold small values (song drafts live in their own table), so
+# they are read from the shared cache and written through to the database.
+# Never with a per-process cache: the other workers would keep serving a
+# session after it changed, a logout included.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
 # email settings
 EMAIL_HOST = 'smtp.example.com'
 EMAIL_PORT = -1
@@ -16,14 +16,15 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin, auth
 from django.core.urlresolvers import reverse_lazy
-from django.contrib.sitemaps.views import sitemap as sitemap_view
+from django.contrib.sitemaps.views import index as sitemap_index_view
 from django.views.generic import TemplateView
 
 from registration.backends.default.views import RegistrationView
 from registration.forms import RegistrationFormUniqueEmail
 from password_validation import validate_password
 
-from chords.sitemaps import StaticViewSitemap, ArtistSitemap, SongSitemap, UserSitemap
+from chords.sitemaps import (StaticViewSitemap, ArtistSitemap, SongSitemap,
+                             UserSitemap, cached_sitemap)
 
 
 class RegistrationViewUniqueEmailPasswordValidation(RegistrationView):
@@ -61,7 +62,8 @@ urlpatterns = [
         'password_validation.views.password_reset_confirm',
         {'post_reset_redirect': reverse_lazy('auth_password_reset_complete')}, name='auth_password_reset_confirm'),
     url(r'^accounts/', include('registration.backends.default.urls')),
-    url(r'^sitemap\.xml$', sitemap_view, {'sitemaps': sitemaps},
+    url(r'^sitemap\.xml$', sitemap_index_view, {'sitemaps': sitemaps}),
+    url(r'^sitemap-(?P<section>.+)\.xml$', cached_sitemap, {'sitemaps': sitemaps},
         name='django.contrib.sitemaps.views.sitemap'),
     url(r'^robots\.txt/$', TemplateView.as_view(template_name='robots.txt',
         content_type='text/plain')),
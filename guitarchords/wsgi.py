@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "guitarchords.settings")
 
 application = get_wsgi_application()
+
+# opt-in: fill the caches, indexes and compiled templates of the worker
+# before it serves any requests, see chords/warmup.py
+if os.getenv('WARM_UP_CACHES') == 'True':
+    from chords.warmup import warm_up
+    warm_up()